@@ -0,0 +1,133 @@
+'''assignment of rows to columns, each column used at most capacity times,
+maximizing total benefit, by the auction algorithm'''
+
+## Bertsekas' auction algorithm, in its Jacobi (all unassigned rows bid
+## at once) form, which vectorizes well, with epsilon scaling.  Each
+## column is an object with capacity identical copies: it holds the
+## capacity highest bids it has received, and, once full, its price is
+## the lowest bid it holds.  Every unassigned row bids for its best
+## column (benefit minus price) by the margin over its second best,
+## plus eps; a column keeps its best bids and sends the rest back to
+## bidding.  The result is within nrows*eps of the optimum total.
+
+import numpy as np
+import verbose as v
+
+def _bids(benefit,price,eps):
+    '''best column, and bid for it, of each row of benefit'''
+    value = benefit - price
+    rows = np.arange(len(value))
+    best = np.argmax(value,axis=1)
+    v1 = value[rows,best]
+    if value.shape[1] > 1:
+        value[rows,best] = -np.inf
+        v2 = np.max(value,axis=1)
+    else:
+        v2 = v1
+    return best,price[best] + (v1 - v2) + eps
+
+def assign(benefit,capacity=1,eps=None):
+    '''
+    column assigned to each row of benefit (nrows,ncols), so that no
+    column gets more than capacity rows, and the total benefit is the
+    maximum (to within nrows*eps; by default, a millionth of the spread
+    of the benefits, over all rows)
+    '''
+    benefit = np.asarray(benefit,dtype=float)
+    nrows,ncols = benefit.shape
+    if ncols*capacity < nrows:
+        raise ValueError(f'Cannot assign {nrows} rows to {ncols} columns, '
+                         f'at most {capacity} each')
+    if nrows == 0:
+        return np.zeros(0,dtype=int)
+    spread = float(benefit.max() - benefit.min())
+    if eps is None:
+        eps = max(spread,1e-12) * 1e-6 / nrows
+    ## Epsilon scaling (a sequence of phases with decreasing eps, each
+    ## starting from the prices of the last) avoids long price wars; but
+    ## then a column may end the last phase not full, with a price left
+    ## over from an earlier phase, and the result is only optimal if
+    ## such columns have price zero.  Those are fixed by reverse auction,
+    ## after every phase (at that phase's eps, so it too is scaled)
+    price = np.zeros(ncols)
+    phase_eps = max(spread/4,eps)
+    while True:
+        col = _auction(benefit,capacity,price,phase_eps)
+        _reverse(benefit,capacity,price,col,phase_eps)
+        if phase_eps <= eps:
+            return col
+        phase_eps = max(phase_eps/5,eps)
+
+def _reverse(benefit,capacity,price,col,eps):
+    '''reverse auction, in place: every column that is not full and has a
+    price takes the rows that most prefer it (from other columns, which
+    may then do the same), and lowers its price to keep them, or to zero'''
+    nrows,ncols = benefit.shape
+    rows = np.arange(nrows)
+    load = np.bincount(col,minlength=ncols)
+    stale = [j for j in range(ncols) if load[j] < capacity and price[j] > 0]
+    profit = benefit[rows,col] - price[col]
+    moves = 0
+    while stale:
+        j = stale.pop()
+        ## as the free copies of column j, bidding at once: take the rows
+        ## with the highest beta (benefit of j, over present profit)
+        inj = col == j
+        beta = benefit[:,j] - profit
+        beta[inj] = -np.inf
+        nfree = nrows - load[j]
+        take = min(capacity - load[j],nfree)
+        if take < nfree:
+            top = np.argpartition(-beta,take)[:take+1]
+            top = top[np.argsort(-beta[top])]
+            top,beta_next = top[:take],beta[top[take]]
+        else:
+            top,beta_next = rows[col != j],-np.inf
+        top = top[beta[top] >= eps]
+        newprice = max(0,beta_next - eps) if len(top) == take else 0
+        profit[inj] += price[j] - newprice
+        price[j] = newprice
+        profit[top] = benefit[top,j] - newprice
+        old = col[top]
+        col[top] = j
+        load[j] += len(top)
+        np.subtract.at(load,old,1)
+        moves += len(top)
+        for k in np.unique(old):
+            if price[k] > 0 and k not in stale:
+                stale.append(k)
+    v.vvprint(f'auction: {moves} reverse moves')
+
+def _auction(benefit,capacity,price,eps):
+    '''one phase of the auction: column of every row, with price
+    (of every column) updated in place'''
+    nrows,ncols = benefit.shape
+    col = np.full(nrows,-1)
+    bid = np.zeros(nrows)
+    rounds = 0
+    while True:
+        un = np.flatnonzero(col < 0)
+        if len(un) == 0:
+            break
+        rounds += 1
+        best,newbid = _bids(benefit[un],price,eps)
+        ## only the columns bid for change hands
+        bidfor = np.zeros(ncols,dtype=bool)
+        bidfor[best] = True
+        held = np.flatnonzero((col >= 0) & bidfor[col])
+        crow = np.concatenate([held,un])
+        ccol = np.concatenate([col[held],best])
+        cbid = np.concatenate([bid[held],newbid])
+        ## by column, highest bid first; keep the first capacity of each
+        order = np.lexsort((-cbid,ccol))
+        crow,ccol,cbid = crow[order],ccol[order],cbid[order]
+        rank = np.arange(len(ccol)) - np.searchsorted(ccol,ccol,side='left')
+        keep = rank < capacity
+        col[held] = -1
+        col[crow[keep]] = ccol[keep]
+        bid[crow[keep]] = cbid[keep]
+        ## full columns are priced at the lowest bid they hold
+        last = rank == capacity-1
+        price[ccol[last]] = cbid[last]
+    v.vvprint(f'auction: eps={eps:.3g} rounds={rounds}')
+    return col
@@ -3,23 +3,37 @@
 import sys
 import argparse
 import random
+import functools
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from PIL import Image
 import verbose as v
 from tqdm import tqdm
 import multifile
+import bands
+import xpand
+from framestats import FrameStats,loadstats
 
 def _getargs():
     '''parse options from command line'''
     argparser = argparse.ArgumentParser(description=__doc__)
     multifile.addargs(argparser)
+    bands.addargs(argparser)
     paa = argparser.add_argument
     paa("--xpand","-x",nargs=2,type=float,
         help="Percentile clips; eg '-x 1 99'")
-    paa("--fcn","-f",default="ave",choices=("ave","min","max"),
+    paa("--fcn","-f",default="ave",choices=("ave","min","max","median","sigclip","pixmin","pixmax"),
         help="how to combine imgages")
+    paa("--sigma",type=float,default=3,
+        help="For --fcn sigclip, leave out values this many standard deviations from the mean")
     paa("--pnorm","-p",type=float,default=1,
         help="p-norm")
+    paa("--instats",action='append',
+        help="Read (and merge) statistics file (repeat for several), instead of or as well as images")
+    paa("--outstats",
+        help="Write statistics (.npz) of the images to this file")
+    paa("--jobs","-j",type=int,default=1,
+        help="Number of processes, each stacking a share of the files")
     paa("--output","-o",default='mean.jpg',
         help="Write output interval image to this file")
     paa("--verbose","-v",action="count",default=0,
@@ -27,6 +41,333 @@ def _getargs():
     args = argparser.parse_args()
     return args
 
+@functools.lru_cache(maxsize=None)
+def _powlut(pnorm):
+    '''table of x**pnorm for the 256 values of an 8-bit pixel'''
+    with np.errstate(divide='ignore'):
+        return np.arange(256,dtype=float)**pnorm
+
+class Stack:
+    '''partial stack of (p-th powers of) frames, combined by fcn;
+    stacks of disjoint sets of frames can be merged'''
+    ## For 8-bit frames, the accumulator is chosen by fcn and pnorm:
+    ## plain sums are uint32 (exact, and much faster than float64),
+    ## min and max are uint8 (x**p is increasing for p>0, so the power
+    ## is taken at the end), and p-th powers come from a lookup table
+    ## instead of a per-pixel pow.  For the median, the accumulator is a
+    ## 256-bin histogram (of 8-bit values) at every pixel, from which the
+    ## median is exact; its counts are uint16 if there are fewer than
+    ## 65536 files (nfiles, over all the stacks to be merged), else
+    ## uint32; at 512 bytes (or 1KB) per pixel and channel, it is worked
+    ## in bands.
+    def __init__(self,fcn='ave',pnorm=1,threads=1,nfiles=None):
+        self.fcn = fcn
+        self.pnorm = pnorm
+        self.threads = threads
+        self.histtype = _histtype(nfiles)
+        self.count = 0
+        self.npacc = None ## sum, min, or max, depending on fcn
+
+    def _newacc(self,npim):
+        '''empty accumulator for frames like npim'''
+        if self.fcn == 'median':
+            if npim.dtype != np.uint8:
+                raise ValueError(f'Median needs 8-bit frames, not {npim.dtype}')
+            return np.zeros(npim.shape+(256,),dtype=self.histtype)
+        if npim.dtype == np.uint8:
+            if self.fcn == 'ave' and self.pnorm == 1:
+                return np.empty(npim.shape,dtype=np.uint32)
+            if self.fcn != 'ave' and self.pnorm > 0:
+                return np.empty(npim.shape,dtype=np.uint8)
+        return np.empty(npim.shape)
+
+    def add(self,npim):
+        '''add a single frame to the stack; rows are split among threads'''
+        if self.count==0:
+            self.npacc = self._newacc(npim)
+        bands.bandmap(lambda rows: self._addrows(self.npacc[rows],npim[rows]),
+                      npim.shape[0],self.threads)
+        self.count += 1
+        return self
+
+    def _addrows(self,npacc,npim):
+        '''combine (some rows of) a frame into npacc, in place'''
+        if self.fcn == 'median':
+            ## one count per pixel, so no index is repeated
+            hist = npacc.reshape(-1,256)
+            hist[np.arange(len(hist)),npim.ravel()] += 1
+            return
+        if npacc.dtype.kind == 'f':
+            if npim.dtype == np.uint8 and self.pnorm != 1:
+                npim = _powlut(self.pnorm)[npim]
+            else:
+                npim = np.asarray(npim,dtype=float)
+                if self.pnorm != 1:
+                    npim = npim ** self.pnorm
+        if self.count==0:
+            npacc[...] = npim
+        elif self.fcn=='min':
+            np.minimum(npacc,npim,out=npacc)
+        elif self.fcn=='max':
+            np.maximum(npacc,npim,out=npacc)
+        else:
+            npacc += npim
+
+    def merge(self,other):
+        '''merge another (partial) stack into this one'''
+        if other.count:
+            self._combine(other.npacc,other.count)
+        return self
+
+    def _combine(self,npacc,count):
+        if self.count==0:
+            self.npacc = npacc
+        elif self.fcn=='min':
+            self.npacc = np.minimum(self.npacc,npacc)
+        elif self.fcn=='max':
+            self.npacc = np.maximum(self.npacc,npacc)
+        else:
+            self.npacc += npacc
+        self.count += count
+
+    def result(self):
+        '''mean, min, max, or median of the p-th powers (as float)'''
+        if self.fcn == 'median':
+            return _median(self.npacc,self.count)
+        npacc = self.npacc
+        if npacc.dtype.kind != 'f':
+            npacc = np.asarray(npacc,dtype=float)
+            if self.fcn != 'ave' and self.pnorm != 1:
+                npacc = npacc ** self.pnorm
+        if self.fcn == 'ave':
+            npacc = npacc / self.count
+        return npacc
+
+def _histtype(nfiles):
+    '''dtype of median histogram counts, for nfiles files (None if unknown)'''
+    if nfiles is not None and nfiles < 2**16:
+        return np.uint16
+    return np.uint32
+
+def _median(hist,count):
+    '''median at every pixel, from histograms (on last axis) of count values;
+    for even count, the mean of the two middle values, as np.median'''
+    ## the total count fits the type of the counts
+    cum = np.cumsum(hist,axis=-1,dtype=hist.dtype)
+    lo = np.argmax(cum > (count-1)//2,axis=-1)
+    hi = np.argmax(cum > count//2,axis=-1)
+    return (lo + hi) / 2
+
+class Welford:
+    '''running mean and variance at every pixel (Welford's algorithm);
+    partial results for disjoint sets of frames can be merged'''
+    def __init__(self,threads=1):
+        self.threads = threads
+        self.count = 0
+        self.mean = self.m2 = None ## m2 is sum of squared deviations
+
+    def add(self,npim):
+        '''add a single frame; rows are split among threads'''
+        if self.count==0:
+            self.mean = np.zeros(npim.shape)
+            self.m2 = np.zeros(npim.shape)
+        self.count += 1
+        bands.bandmap(lambda rows: self._addrows(self.mean[rows],self.m2[rows],
+                                                 npim[rows]),
+                      npim.shape[0],self.threads)
+        return self
+
+    def _addrows(self,mean,m2,npim):
+        npim = np.asarray(npim,dtype=float)
+        delta = npim - mean
+        mean += delta / self.count
+        m2 += delta * (npim - mean)
+
+    def merge(self,other):
+        '''merge partial results for a disjoint set of frames into these'''
+        if other.count==0:
+            return self
+        if self.count==0:
+            self.count,self.mean,self.m2 = other.count,other.mean,other.m2
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * (other.count/count)
+        self.m2 += other.m2 + delta**2 * (self.count*other.count/count)
+        self.count = count
+        return self
+
+    def std(self):
+        return np.sqrt(self.m2/self.count)
+
+class ClippedMean:
+    '''mean at every pixel of those values that are within sigma standard
+    deviations of the (unclipped) mean; where there are none, the mean'''
+    def __init__(self,mean,std,sigma=3,threads=1):
+        self.mean = mean
+        self.lo = mean - sigma*std
+        self.hi = mean + sigma*std
+        self.threads = threads
+        self.count = 0
+        self.sum = self.nkept = None
+
+    def add(self,npim):
+        '''add a single frame; rows are split among threads'''
+        if self.count==0:
+            self.sum = np.zeros(npim.shape)
+            self.nkept = np.zeros(npim.shape,dtype=np.uint32)
+        bands.bandmap(lambda rows: self._addrows(self.sum[rows],self.nkept[rows],
+                                                 self.lo[rows],self.hi[rows],
+                                                 npim[rows]),
+                      npim.shape[0],self.threads)
+        self.count += 1
+        return self
+
+    def _addrows(self,npsum,nkept,lo,hi,npim):
+        npim = np.asarray(npim,dtype=float)
+        keep = (npim >= lo) & (npim <= hi)
+        np.add(npsum,npim,out=npsum,where=keep)
+        nkept += keep
+
+    def merge(self,other):
+        if other.count==0:
+            return self
+        if self.count==0:
+            self.count,self.sum,self.nkept = other.count,other.sum,other.nkept
+            return self
+        self.sum += other.sum
+        self.nkept += other.nkept
+        self.count += other.count
+        return self
+
+    def result(self):
+        with np.errstate(invalid='ignore',divide='ignore'):
+            return np.where(self.nkept > 0,self.sum/self.nkept,self.mean)
+
+_LUMA = np.array([0.299,0.587,0.114]) ## as PIL converts RGB to L
+
+def _luminance(npim):
+    '''luminance at every pixel of an RGB (or grey) image'''
+    npim = np.asarray(npim,dtype=float)
+    if npim.ndim == 2:
+        return npim
+    return npim[...,:3] @ _LUMA
+
+class PixelStack:
+    '''whole pixel (all channels together) with the min or max luminance
+    at every pixel, so no false colors; ties go to the earlier frame'''
+    def __init__(self,fcn='pixmax',threads=1):
+        self.fcn = fcn
+        self.threads = threads
+        self.count = 0
+        self.lum = self.npacc = None
+
+    def add(self,npim):
+        '''add a single frame; rows are split among threads'''
+        if self.count==0:
+            worst = np.inf if self.fcn == 'pixmin' else -np.inf
+            self.lum = np.full(npim.shape[:2],worst)
+            self.npacc = np.zeros(npim.shape,dtype=npim.dtype)
+        bands.bandmap(lambda rows: self._addrows(self.lum[rows],self.npacc[rows],
+                                                 _luminance(npim[rows]),npim[rows]),
+                      npim.shape[0],self.threads)
+        self.count += 1
+        return self
+
+    def _addrows(self,lum,npacc,frlum,npim):
+        '''keep, in place, the pixels of npim whose luminance is better'''
+        better = np.less if self.fcn == 'pixmin' else np.greater
+        win = better(frlum,lum)
+        lum[win] = frlum[win]
+        npacc[win] = npim[win]
+
+    def merge(self,other):
+        '''merge a stack of a disjoint set of (later) frames into this one'''
+        if other.count==0:
+            return self
+        if self.count==0:
+            self.count,self.lum,self.npacc = other.count,other.lum,other.npacc
+            return self
+        self._addrows(self.lum,self.npacc,other.lum,other.npacc)
+        self.count += other.count
+        return self
+
+    def result(self):
+        return np.asarray(self.npacc,dtype=float)
+
+def _newstack(args,nfiles=None):
+    '''empty stack (for nfiles files, over all jobs); full statistics if
+    they are to be read or written'''
+    if args.instats or args.outstats:
+        return FrameStats()
+    if args.fcn in ('pixmin','pixmax'):
+        return PixelStack(args.fcn,args.threads)
+    return Stack(args.fcn,args.pnorm,args.threads,nfiles)
+
+def _stack(allfiles,args,quiet=False,rows=slice(None),stack=None):
+    '''stack (the given rows of) the frames in allfiles, into stack
+    (by default, an empty one from _newstack)'''
+    cache = multifile.getcache(args)
+    if stack is None:
+        stack = _newstack(args)
+    frames = multifile.getframes(allfiles,args,cache)
+    if not quiet:
+        frames = v.vtqdm(frames,total=len(allfiles))
+    for n,infile,npim,exif in frames:
+        stack.add(npim[rows])
+    return stack
+
+def _stack_jobs(allfiles,args,rows=slice(None),stack=None):
+    '''map-reduce: split files among processes, each stacking into a copy
+    of (empty) stack, then merge partial stacks'''
+    nfiles = len(allfiles)
+    njobs = min(args.jobs,nfiles)
+    shares = [allfiles[j*nfiles//njobs:(j+1)*nfiles//njobs]
+              for j in range(njobs)]
+    merged = None
+    with ProcessPoolExecutor(max_workers=njobs) as pool:
+        partials = pool.map(_stack,shares,[args]*njobs,[True]*njobs,
+                            [rows]*njobs,[stack]*njobs)
+        for partial in v.vtqdm(partials,total=njobs):
+            merged = partial if merged is None else merged.merge(partial)
+    return merged
+
+def _runstack(allfiles,args,rows=slice(None),quiet=False,stack=None):
+    '''stack, in one process or (with --jobs) several'''
+    if args.jobs > 1 and allfiles:
+        return _stack_jobs(allfiles,args,rows,stack)
+    return _stack(allfiles,args,quiet,rows,stack)
+
+def _stackband(allfiles,args,rows=slice(None),quiet=False):
+    '''stacked image (mean, min, max, median, sigma-clipped mean, or
+    whole-pixel min or max; after p-norm), for the given rows'''
+    if args.fcn == 'sigclip':
+        ## one pass for mean and standard deviation, and a second
+        ## for the mean of the values not too far from that mean
+        moments = _runstack(allfiles,args,rows,quiet,Welford(args.threads))
+        stack = _runstack(allfiles,args,rows,quiet,
+                          ClippedMean(moments.mean,moments.std(),
+                                      args.sigma,args.threads))
+    else:
+        stack = _runstack(allfiles,args,rows,quiet,
+                          _newstack(args,len(allfiles)))
+
+    if args.instats or args.outstats:
+        if args.instats:
+            stack.merge(loadstats(args.instats))
+        if args.outstats:
+            stack.save(args.outstats)
+        npmean = stack.stack(args.fcn,args.pnorm)
+    else:
+        npmean = stack.result()
+
+    if not quiet:
+        v.vprint('Base image:',npmean.shape,np.min(npmean),np.max(npmean))
+
+    if args.pnorm != 1:
+        npmean = npmean ** (1/args.pnorm)
+    return npmean
+
 def _main(args):
     '''main'''
     v.vprint(args)
@@ -34,36 +375,57 @@ def _main(args):
     allfiles = multifile.getfiles(args)
 
     imbase = None
-    nfiles = len(allfiles)
-    for n,infile in v.vtqdm(enumerate(allfiles),total=nfiles):
-        with Image.open(infile) as im:
-            npim = np.array(im,dtype=float)
-            if args.pnorm != 1:
-                npim = npim ** args.pnorm
-            if n==0:
-                npmean = npim
-                exifbase = im.getexif()
-            else:
-                if args.fcn=='min':
-                    npmean = np.minimum(npmean,npim)
-                elif args.fcn=='max':
-                    npmean = np.maximum(npmean,npim)
-                else:
-                    npmean += npim
+    ## exif, and image size, from the first file that opens
+    basefile = multifile.firstfile(allfiles)
+    exifbase = multifile.readexif(basefile) if basefile else None
 
-    if args.fcn == 'ave':
-        npmean /= nfiles
+    if args.max_memory and (args.instats or args.outstats):
+        raise RuntimeError('Cannot use --max-memory with --instats or --outstats')
+    if args.pnorm == 0:
+        raise RuntimeError('Cannot use --pnorm 0 (every x**0 is 1)')
+    if args.fcn in ('median','sigclip','pixmin','pixmax'):
+        if args.instats or args.outstats:
+            raise RuntimeError(f'Statistics files do not give the {args.fcn}')
+        if args.pnorm != 1:
+            raise RuntimeError(f'Cannot use --pnorm with --fcn {args.fcn}')
+    if (args.fcn == 'ave' and (args.instats or args.outstats)
+        and args.pnorm not in (1,2)):
+        raise RuntimeError('Statistics files give the average '
+                           'only for --pnorm 1 or 2')
+    ## median histograms (and their cumulative sums) take 256 counts
+    ## per pixel and channel, so the median is always worked in bands
+    histbytes = np.dtype(_histtype(len(allfiles))).itemsize
+    if args.fcn == 'median' and not args.max_memory:
+        args.max_memory = 4
+        v.vprint(f'Median: using --max-memory {args.max_memory} (GB)')
+    narrays = {'median': 2*256*histbytes//8 + 2, 'sigclip': 6}.get(args.fcn,3)
+    bandlist = bands.getbands(args,basefile,narrays) if basefile else [None]
+    ## percentiles for --xpand come from a histogram of the bands
+    hist = xpand.Histogram() if args.xpand else None
+    with bands.bandcache(args,len(bandlist) > 1):
+        if len(bandlist) == 1:
+            npmean = _stackband(allfiles,args)
+            if hist:
+                hist.add(npmean)
+        else:
+            ## floats are only needed for the stretch of --xpand (and
+            ## then as the bands are, so as not to round them: the
+            ## histogram must be of exactly the values that are stretched)
+            npmean = None
+            for rows in v.vtqdm(bandlist):
+                npband = _stackband(allfiles,args,rows,quiet=True)
+                if npmean is None:
+                    height = bandlist[-1].stop
+                    npmean = np.empty((height,)+npband.shape[1:],
+                                      dtype=npband.dtype if args.xpand else np.uint8)
+                npmean[rows] = npband
+                if hist:
+                    hist.add(npmean[rows])
 
-    v.vprint('Base image:',npmean.shape,np.min(npmean),np.max(npmean))        
-        
-    if args.pnorm != 1:
-        npmean = npmean ** (1/args.pnorm)
-                
     if args.xpand:
-        xlo,xhi = np.percentile(npmean,args.xpand)
+        xlo,xhi = hist.percentile(args.xpand,npmean)
         v.vprint('Expand:',xlo,xhi,255/(xhi-xlo))
-        npmean = 255*(npmean - xlo)/(xhi-xlo)
-        npmean = np.clip(npmean,0,255)
+        npmean = xpand.stretch(npmean,xlo,xhi)
 
     v.vprint('Base image:',npmean.shape,np.min(npmean),np.max(npmean))        
     npmean = np.asarray(npmean,dtype=np.uint8)
@@ -74,7 +436,10 @@ def _main(args):
         v.vprint('imbase:',imbase.info.keys())
         immean = imbase
 
-    immean.save(args.output,quality="high",exif=exifbase)
+    if exifbase is None:
+        immean.save(args.output,quality="high")
+    else:
+        immean.save(args.output,quality="high",exif=exifbase)
         
 if __name__ == "__main__":
 
@@ -0,0 +1,101 @@
+'''split images into horizontal bands of rows, so per-pixel work fits in memory'''
+
+## In band mode, every pass over the input files is done once per band,
+## on just the rows of that band; so frames should be decoded only once,
+## into the frame cache, and then read (band by band) from there as
+## memory-mapped arrays.  If no --cache is given, a temporary one is used.
+##
+## What --max-memory bounds is the per-pixel float working arrays (the
+## accumulators, distances, and temporaries of the passes) of a band,
+## for all --jobs processes together; threads split a band, and do not
+## add to it.  Not counted: the output image; per-pixel index and label
+## maps (2 or 4 bytes per pixel: the smallest integer type that fits);
+## decoding, which makes the whole of one frame (per --workers thread)
+## before it goes to the cache; and the frame cache, which is on disk,
+## and holds every decoded frame, since every band needs every frame.
+##
+## Bands of rows are also the unit of work for threads: numpy releases
+## the GIL inside its kernels, so per-pixel work on a single frame can
+## be split into (smaller) bands that run in parallel on a thread pool.
+
+import shutil
+import tempfile
+import contextlib
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+import verbose as v
+
+def addargs(ap):
+    '''add argparse arguments for: max-memory, threads'''
+    paa = ap.add_argument
+    paa("--max-memory",type=float,
+        help="Work in bands of rows, with at most this much (GB) in per-pixel arrays")
+    paa("--threads",type=int,default=1,
+        help="Number of threads for per-pixel work on each frame")
+
+def rowbands(height,rowbytes,maxbytes=None):
+    '''list of slices that split height rows into bands of at most maxbytes'''
+    if not maxbytes:
+        return [slice(0,height)]
+    nrows = max(1,int(maxbytes // rowbytes))
+    return [slice(r,min(r+nrows,height)) for r in range(0,height,nrows)]
+
+def getbands(args,infile,narrays):
+    '''bands for images the size of infile, where the work needs narrays
+    float64 arrays of shape (height,width,nchannels)'''
+    with Image.open(infile) as im:
+        width,height = im.size
+        nchannels = len(im.getbands())
+    maxbytes = int(args.max_memory * 2**30) if args.max_memory else None
+    ## every --jobs process holds its own per-pixel arrays for the band
+    njobs = getattr(args,'jobs',1)
+    if maxbytes and njobs > 1:
+        maxbytes //= njobs
+    bands = rowbands(height,width*nchannels*8*narrays,maxbytes)
+    if len(bands) > 1:
+        v.vprint(f'Working in {len(bands)} bands of {bands[0].stop} rows')
+    return bands
+
+@contextlib.contextmanager
+def bandcache(args,banded=True):
+    '''in band mode, make sure frames go through a frame cache, using a
+    temporary one (removed afterwards) if --cache was not specified;
+    either way, with no --cachesize limit'''
+    if not banded:
+        yield
+        return
+    if args.cache:
+        ## every band reads every frame, in the same order: with a
+        ## cache too small for them all, every read would be an LRU
+        ## miss, and every band would decode every frame again
+        if args.cachesize:
+            v.vprint(f'Band mode: --cachesize {args.cachesize} lifted, '
+                     'so every frame is decoded only once')
+            args.cachesize = 0
+        yield
+        return
+    tmpdir = tempfile.mkdtemp(prefix='slice-n-dice-')
+    v.vprint('Temporary frame cache:',tmpdir)
+    args.cache = tmpdir
+    args.cachesize = 0 ## no limit (on disk): every band needs every frame
+    try:
+        yield
+    finally:
+        shutil.rmtree(tmpdir,ignore_errors=True)
+        args.cache = None
+
+@functools.lru_cache(maxsize=None)
+def _threadpool(nthreads):
+    return ThreadPoolExecutor(max_workers=nthreads)
+
+def bandmap(fcn,height,nthreads=1):
+    '''list of fcn(rows), for height rows split into nthreads bands,
+    each run on its own thread; fcn should work on (views of) just
+    those rows, so the bands do not contend'''
+    if nthreads <= 1 or height < 2:
+        return [fcn(slice(0,height))]
+    nthreads = min(nthreads,height)
+    bandlist = [slice(k*height//nthreads,(k+1)*height//nthreads)
+                for k in range(nthreads)]
+    return list(_threadpool(nthreads).map(fcn,bandlist))
@@ -0,0 +1,124 @@
+'''on-disk cache of decoded image frames, as memory-mapped .npy files'''
+
+## Decoding a JPEG is the most expensive part of reading a frame, and
+## most of the routines here read the same files two or three times
+## per run (and the same files are often used over many runs).  The
+## cache keeps the decoded uint8 pixels of each file in its own .npy
+## file, keyed by the path, size, and modification time of the image
+## file, and returns them as a read-only np.memmap, so that a cache
+## hit costs no decoding and no copying.
+##
+## Total size of the cache is capped; when it grows past the cap, the
+## least recently used frames are evicted.  "Recently used" is tracked
+## by the mtime of the .npy file, which is touched on every hit.
+
+import os
+import hashlib
+import threading
+import numpy as np
+from PIL import Image
+import verbose as v
+
+def reduced_size(size,scale):
+    '''size (width,height) of image reduced by scale, rounding up'''
+    width,height = size
+    return ((width+scale-1)//scale,(height+scale-1)//scale)
+
+def decode(infile,scale=1):
+    '''decoded image as uint8 array; with scale>1, reduced in size by
+    that factor (rounding up), using JPEG draft mode where possible,
+    so most of the reduction is done in the DCT, before decoding'''
+    with Image.open(infile) as im:
+        if scale > 1:
+            size = reduced_size(im.size,scale)
+            im.draft(im.mode,size)
+            if im.size != size:
+                im = im.resize(size,resample=Image.Resampling.BOX)
+        return np.asarray(im)
+
+def reduce_array(npim,scale):
+    '''float array (height,width,channels) reduced in size as decode
+    would reduce the image (box filter), one channel at a time'''
+    size = reduced_size(npim.shape[1::-1],scale)
+    channels = [Image.fromarray(np.asarray(npim[:,:,c],dtype=np.float32))
+                .resize(size,resample=Image.Resampling.BOX)
+                for c in range(npim.shape[2])]
+    return np.stack([np.asarray(ch,dtype=float) for ch in channels],axis=2)
+
+def filestamp(infile):
+    '''string identifying file: path, size, and mtime'''
+    st = os.stat(infile)
+    return f'{os.path.abspath(infile)}|{st.st_size}|{st.st_mtime_ns}'
+
+class FrameCache:
+    '''decoded frames, keyed by path, size, and mtime of the image file'''
+    def __init__(self,cachedir,maxbytes=None):
+        self.cachedir = cachedir
+        self.maxbytes = maxbytes
+        os.makedirs(cachedir,exist_ok=True)
+
+    def key(self,infile,scale=1):
+        '''cache key for image file; changes if the file changes'''
+        ident = filestamp(infile) + (f'|{scale}' if scale > 1 else '')
+        return hashlib.sha1(ident.encode()).hexdigest()
+
+    def cachefile(self,infile,scale=1):
+        return os.path.join(self.cachedir,self.key(infile,scale) + '.npy')
+
+    def get(self,infile,scale=1):
+        '''return decoded frame (reduced by scale) as a read-only memmap'''
+        cfile = self.cachefile(infile,scale)
+        try:
+            frame = np.load(cfile,mmap_mode='r')
+            os.utime(cfile) ## mark as recently used
+            return frame
+        except (OSError,ValueError):
+            ## not in cache (or a corrupted entry), so decode it
+            pass
+        npim = decode(infile,scale)
+        self.put(cfile,npim)
+        try:
+            return np.load(cfile,mmap_mode='r')
+        except FileNotFoundError:
+            ## evicted (by another thread) before we could read it back
+            return npim
+
+    def put(self,cfile,npim):
+        '''write frame to cache, then evict if cache is too big'''
+        ## write to a temporary name and then rename, so a crashed
+        ## (or concurrent) run never sees a partially-written frame
+        tmpfile = f'{cfile}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmpfile,'wb') as fp:
+            np.save(fp,npim)
+        os.replace(tmpfile,cfile)
+        if self.maxbytes:
+            self.evict(keep=cfile)
+
+    def entries(self):
+        '''list of (mtime,size,path) for all frames in the cache'''
+        entries = []
+        with os.scandir(self.cachedir) as it:
+            for entry in it:
+                if entry.name.endswith('.npy'):
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append( (st.st_mtime_ns,st.st_size,entry.path) )
+        return entries
+
+    def evict(self,keep=None):
+        '''remove least recently used frames until under maxbytes'''
+        entries = sorted(self.entries())
+        total = sum(size for _,size,_ in entries)
+        for _,size,path in entries:
+            if total <= self.maxbytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+                v.vvprint('Evicted from frame cache:',path)
+            except FileNotFoundError:
+                pass
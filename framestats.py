@@ -0,0 +1,184 @@
+'''per-pixel statistics of a stack of frames, in mergeable .npz files'''
+
+## The statistics (sum, sum of squares, count, min, and max at every
+## pixel) are sufficient for the mean and variance, and for the
+## average routine's ave/min/max (with pnorm 1 or 2).  Statistics of
+## disjoint sets of frames merge exactly, so the first pass over a
+## large archive can be sharded across machines (or nights), and new
+## frames can be appended without re-reading the old ones:
+##
+##   python -m average night1/*.JPG --outstats night1.npz
+##   python -m average night2/*.JPG --outstats night2.npz
+##   python -m framestats night1.npz night2.npz -o both.npz
+##   python -m pixanom night*/*.JPG --instats both.npz -o anom.jpg
+##
+## Sums are kept as float64, not float32: with float32, the sum of
+## squares of 8-bit values stops being exact after a few hundred frames.
+
+import argparse
+from collections import deque
+import numpy as np
+import verbose as v
+
+class FrameStats:
+    '''per-pixel sum, sum of squares, count, min, and max of frames;
+    with full=False, only the sum and count are kept'''
+    def __init__(self,full=True):
+        self.full = full
+        self.count = 0
+        self.sum = self.sumsq = self.min = self.max = None
+
+    def add(self,npim):
+        '''add a single (uint8) frame'''
+        npfloat = np.array(npim,dtype=float)
+        if self.count==0:
+            self.sum = npfloat
+            if self.full:
+                self.sumsq = npfloat**2
+                self.min = np.array(npim)
+                self.max = np.array(npim)
+        else:
+            self.sum += npfloat
+            if self.full:
+                self.sumsq += npfloat**2
+                np.minimum(self.min,npim,out=self.min)
+                np.maximum(self.max,npim,out=self.max)
+        self.count += 1
+        return self
+
+    def merge(self,other):
+        '''merge statistics of a disjoint set of frames into these'''
+        if other.count==0:
+            return self
+        if self.count==0:
+            self.full = other.full
+            self.sum = other.sum.copy()
+            if self.full:
+                self.sumsq = other.sumsq.copy()
+                self.min = other.min.copy()
+                self.max = other.max.copy()
+            self.count = other.count
+            return self
+        if self.sum.shape != other.sum.shape:
+            raise ValueError(f'Cannot merge statistics of frames with shape '
+                             f'{other.sum.shape} into {self.sum.shape}')
+        self.full = self.full and other.full
+        self.sum += other.sum
+        if self.full:
+            self.sumsq += other.sumsq
+            np.minimum(self.min,other.min,out=self.min)
+            np.maximum(self.max,other.max,out=self.max)
+        self.count += other.count
+        return self
+
+    def mean(self):
+        return self.sum / self.count
+
+    def variance(self):
+        return np.maximum(self.sumsq/self.count - self.mean()**2,0)
+
+    def stack(self,fcn='ave',pnorm=1):
+        '''mean, min, or max of the p-th powers of the frames'''
+        if fcn in ('min','max'):
+            if pnorm == 0:
+                raise ValueError('Statistics give no min or max for pnorm 0')
+            ## x**p is decreasing for p<0: its min is at the max of x
+            if (fcn == 'min') == (pnorm > 0):
+                extreme = self.min
+            else:
+                extreme = self.max
+            with np.errstate(divide='ignore'):
+                return np.array(extreme,dtype=float)**pnorm
+        if pnorm == 1:
+            return self.mean()
+        if pnorm == 2:
+            return self.sumsq / self.count
+        raise ValueError(f'Statistics give the average only for pnorm 1 or 2, '
+                         f'not {pnorm}')
+
+    def save(self,filename):
+        if not self.full:
+            raise ValueError('Cannot save statistics that are not full')
+        np.savez_compressed(filename,sum=self.sum,sumsq=self.sumsq,
+                            count=self.count,min=self.min,max=self.max)
+
+    @classmethod
+    def load(cls,filename):
+        stats = cls()
+        with np.load(filename) as npz:
+            stats.sum = npz['sum']
+            stats.sumsq = npz['sumsq']
+            stats.count = int(npz['count'])
+            stats.min = npz['min']
+            stats.max = npz['max']
+        return stats
+
+def moving_means(frames,window):
+    '''
+    for each (n,infile,npim,exif) from frames, yield (n,infile,npim,exif,npmean),
+    where npmean is the mean of the window frames centered on that one
+    (fewer near the ends of the sequence); a ring buffer keeps the frames
+    of the window and a running sum is updated as frames enter and leave,
+    so each frame is read once, and the work per frame does not grow
+    with the window
+    '''
+    before = window//2
+    after = window - 1 - before
+    ring = deque()
+    total = None
+    emit = 0 ## position in ring of next frame to yield
+    def _yield():
+        nonlocal emit,total
+        item = ring[emit]
+        emit += 1
+        out = item + (total / len(ring),)
+        ## drop frames that are not in the window of the next one
+        while emit > before:
+            total -= ring.popleft()[2]
+            emit -= 1
+        return out
+    for item in frames:
+        npim = item[2]
+        if total is None:
+            total = np.zeros(npim.shape,
+                             dtype=np.int64 if npim.dtype.kind in 'ui' else float)
+        ring.append(item)
+        total += npim
+        while len(ring) - 1 - emit >= after:
+            yield _yield()
+    while ring and emit < len(ring):
+        yield _yield()
+
+def loadstats(filenames):
+    '''load and merge statistics from several files'''
+    stats = FrameStats()
+    for filename in filenames:
+        v.vprint('Reading statistics:',filename)
+        stats.merge(FrameStats.load(filename))
+    return stats
+
+def _getargs():
+    '''parse options from command line'''
+    argparser = argparse.ArgumentParser(description=__doc__)
+    paa = argparser.add_argument
+    paa("files",nargs='+',
+        help="Statistics files to be merged")
+    paa("--output","-o",required=True,
+        help="Write merged statistics to this file")
+    paa("--verbose","-v",action="count",default=0,
+        help="verbose")
+    args = argparser.parse_args()
+    return args
+
+def _main(args):
+    '''main'''
+    v.vprint(args)
+    stats = loadstats(args.files)
+    v.vprint('Frames:',stats.count,'Shape:',stats.sum.shape)
+    stats.save(args.output)
+
+if __name__ == "__main__":
+
+    _args = _getargs()
+    v.verbosity(_args.verbose)
+    _main(_args)
@@ -3,7 +3,8 @@
 import sys
 import argparse
 import random
-from PIL import Image
+import numpy as np
+from PIL import Image,ImageColor
 import verbose as v
 
 def _getargs():
@@ -29,48 +30,77 @@ def _getargs():
     args = argparser.parse_args()
     return args
 
-def _main(args):
-    '''main'''
-    v.vprint(args)
+def _gapindex(npixels,nstripes,gap,framegap):
+    '''position, in the gapped image, of every pixel along one axis'''
+    lo = np.arange(nstripes) * npixels // nstripes
+    stripe = np.searchsorted(lo,np.arange(npixels),side='right') - 1
+    return np.arange(npixels) + stripe*gap + framegap
+
+def _runs(index):
+    '''(start,stop,to) of every run of consecutive values in index, which
+    goes from positions start:stop to to:to+stop-start'''
+    breaks = np.flatnonzero(np.diff(index) != 1) + 1
+    starts = np.r_[0,breaks]
+    stops = np.r_[breaks,len(index)]
+    return list(zip(starts.tolist(),stops.tolist(),index[starts].tolist()))
 
-    nwstripes,nhstripes = args.tiles
-    basefile = args.file
-    framegap = args.gap if args.frame else 0
-    with Image.open(basefile) as baseim:
-        owidth,oheight = baseim.size 
-        if args.angle:
-            baseim = baseim.rotate(args.angle,expand=True)
-        width,height = baseim.size
+def _filled(shape,dtype,fill):
+    '''array of shape, every pixel fill (filling one row, then copying it
+    to the rest, is much faster than broadcasting a color to every pixel)'''
+    out = np.empty(shape,dtype=dtype)
+    out[0] = fill
+    out[1:] = out[0]
+    return out
 
-        gwidth = width + (nwstripes-1)*args.gap + 2*framegap
-        gheight = height + (nhstripes-1)*args.gap + 2*framegap
-        v.vprint(f'G: {gwidth}x{gheight}')
-        gapim = Image.new('RGB',(gwidth,gheight),
-                          color=args.color)
+def gapped(npim,ntiles,gap,frame=False,color=None):
+    '''
+    array npim (height,width,channels) with gaps of gap pixels between
+    its ntiles (nw,nh) stripes, and a frame as wide around it; gaps and
+    frame are color (a PIL color string; default black)
+    '''
+    ## index arrays give where every row and column goes; each run of
+    ## them is copied as one slice (much faster than a fancy-indexed
+    ## copy of every pixel), columns first, into a band as wide as the
+    ## output, then rows: nw+nh copies in all, not nw*nh
+    nwstripes,nhstripes = ntiles
+    height,width = npim.shape[:2]
+    framegap = gap if frame else 0
+    gwidth = width + (nwstripes-1)*gap + 2*framegap
+    gheight = height + (nhstripes-1)*gap + 2*framegap
+    v.vprint(f'G: {gwidth}x{gheight}')
+    fill = ImageColor.getcolor(color,'RGB') if color else 0
+    gapnp = _filled((gheight,gwidth)+npim.shape[2:],npim.dtype,fill)
+    rowruns = _runs(_gapindex(height,nhstripes,gap,framegap))
+    if len(rowruns) == 1:
+        wide = gapnp[framegap:framegap+height]
+    else:
+        wide = _filled((height,gwidth)+npim.shape[2:],npim.dtype,fill)
+    for start,stop,to in _runs(_gapindex(width,nwstripes,gap,framegap)):
+        wide[:,to:to+stop-start] = npim[:,start:stop]
+    if len(rowruns) > 1:
+        for start,stop,to in rowruns:
+            gapnp[to:to+stop-start] = wide[start:stop]
+    return gapnp
 
-        for nw in range(nwstripes):
-            for nh in range(nhstripes):
-                wlo = nw*width//nwstripes
-                whi = (1+nw)*width//nwstripes
-                hlo = nh*height//nhstripes
-                hhi = (1+nh)*height//nhstripes
-                box = (wlo,hlo,whi,hhi)
-                          
-                gwlo = wlo + nw*args.gap + framegap
-                gwhi = gwlo + (whi-wlo)
-                ghlo = hlo + nh*args.gap + framegap
-                ghhi = ghlo + (hhi-hlo)
-                gbox = (gwlo,ghlo,gwhi,ghhi)
+def gapify(im,ntiles,gap,frame=False,color=None,angle=0):
+    '''RGB image im with gaps (see gapped); with angle, the gaps are at
+    that angle: im is rotated, gapped, and rotated back'''
+    if angle:
+        im = im.rotate(angle,expand=True)
+    gapim = Image.fromarray(gapped(np.asarray(im.convert('RGB')),ntiles,
+                                   gap,frame,color))
+    if angle:
+        ## fixme!
+        gapim = gapim.rotate(-angle,expand=False)
+    return gapim
 
-                region = baseim.crop(box)
-                gapim.paste(region,gbox)
+def _main(args):
+    '''main'''
+    v.vprint(args)
 
-        if args.angle:
-            ## fixme!
-            gapim = gapim.rotate(-args.angle,expand=False)
-            if False:
-                gapim = gapim.crop(((width-owidth)//2,(height-oheight)//2,
-                                    (width+owidth)//2,(height+oheight)//2))
+    with Image.open(args.file) as baseim:
+        gapim = gapify(baseim,args.tiles,args.gap,frame=args.frame,
+                       color=args.color,angle=args.angle)
         gapim.save(args.output,quality="high",exif=baseim.getexif())
     
 if __name__ == "__main__":
@@ -1,5 +1,11 @@
 '''specify a "range" of files'''
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
 from intlist import str_intgen
+import verbose as v
+from framecache import FrameCache,decode
 
 def files_fromstring(str_intrange,**kw):
     intrange = str_intgen(str_intrange)
@@ -20,6 +26,14 @@ def addargs(ap):
         help="Range of numbers for input files, eg 9700-9737")
     paa("--inputpattern",default="DSC_%04d.JPG",
         help="filename pattern") #; eg 'DSC_%04d.JPG'")
+    paa("--cache",
+        help="Directory for cache of decoded frames")
+    paa("--cachesize",type=float,default=20,
+        help="Maximum size of frame cache (GB)")
+    paa("--workers",type=int,default=0,
+        help="Number of threads for decoding frames ahead")
+    paa("--prefetch",type=int,default=0,
+        help="How many frames to decode ahead [default: 2*workers]")
 
 def getfiles(args):
     if args.files:
@@ -30,6 +44,97 @@ def getfiles(args):
                                     pattern=args.inputpattern)
     return allfiles
 
+def getcache(args):
+    '''frame cache specified by args, or None if not caching'''
+    if not args.cache:
+        return None
+    return FrameCache(args.cache,maxbytes=int(args.cachesize * 2**30))
+
+def readframe(infile,cache=None,scale=1):
+    '''decoded image as uint8 array (read-only memmap if cached);
+    with scale>1, reduced in size by that factor'''
+    if cache:
+        return cache.get(infile,scale)
+    return decode(infile,scale)
+
+def readexif(infile):
+    '''exif info from image file (reads header, does not decode)'''
+    with Image.open(infile) as im:
+        return im.getexif()
+
+def firstfile(allfiles):
+    '''the first of allfiles that opens (None if none do); files that
+    fail to open are skipped, as by iterframes'''
+    for infile in allfiles:
+        try:
+            with Image.open(infile):
+                return infile
+        except OSError:
+            continue
+    return None
+
+def checkshape(npim,allfiles,source):
+    '''raise RuntimeError unless npim (a mean, from source) has the shape
+    of the frames (of the first of allfiles that opens)'''
+    infile = firstfile(allfiles)
+    if infile is None:
+        return
+    with Image.open(infile) as im:
+        width,height = im.size
+        nchannels = len(im.getbands())
+    shape = (height,width) + ((nchannels,) if nchannels > 1 else ())
+    if npim.shape != shape:
+        raise RuntimeError(f'Mean from {source} has shape {npim.shape}, '
+                           f'but the frames have shape {shape}')
+
+def _loadframe(infile,cache=None,scale=1,exif=False):
+    ## exif only on request: it means opening the file again, even when
+    ## the frame itself comes from the cache
+    return readframe(infile,cache,scale),readexif(infile) if exif else None
+
+def iterframes(allfiles,cache=None,workers=0,depth=0,scale=1,exif=False):
+    '''
+    iterate over (n,infile,npim,exif) for all files, in order;
+    with workers>0, frames are decoded ahead (by at most depth frames)
+    in a pool of threads; files that fail to open are reported and skipped;
+    with scale>1, frames are reduced in size by that factor;
+    exif is None unless exif=True
+    '''
+    if not workers:
+        for n,infile in enumerate(allfiles):
+            try:
+                npim,frameexif = _loadframe(infile,cache,scale,exif)
+            except OSError:
+                v.print('Failed to open file:',infile)
+                continue
+            yield n,infile,npim,frameexif
+        return
+
+    depth = depth or 2*workers
+    fileiter = enumerate(allfiles)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        def submit(nfile):
+            n,infile = nfile
+            pending.append((n,infile,pool.submit(_loadframe,infile,cache,scale,exif)))
+        for nfile in itertools.islice(fileiter,depth):
+            submit(nfile)
+        while pending:
+            n,infile,future = pending.popleft()
+            for nfile in itertools.islice(fileiter,1):
+                submit(nfile)
+            try:
+                npim,frameexif = future.result()
+            except OSError:
+                v.print('Failed to open file:',infile)
+                continue
+            yield n,infile,npim,frameexif
+
+def getframes(allfiles,args,cache=None,scale=1,exif=False):
+    '''iterframes, with workers and prefetch depth specified by args'''
+    return iterframes(allfiles,cache=cache,scale=scale,exif=exif,
+                      workers=args.workers,depth=args.prefetch)
+
 if __name__ == "__main__":
 
     f = files_fromstring('9700-9736',dir='2023_06_06a')
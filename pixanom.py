@@ -8,14 +8,24 @@ from PIL import Image
 import verbose as v
 from tqdm import tqdm
 import multifile
+import bands
+import xpand
+from framestats import FrameStats,loadstats,moving_means
+from framecache import reduce_array
+from tiles import pixel_groups,composite,upsample_labels,save_labels,load_labels,label_dtype
 
 def _getargs():
     '''parse options from command line'''
     argparser = argparse.ArgumentParser(description=__doc__)
     multifile.addargs(argparser)
+    bands.addargs(argparser)
     paa = argparser.add_argument
     paa("--mindist",action="store_true",
         help="Use least anomalous (minimum distance) tiles")
+    paa("--rank",type=int,default=1,
+        help="Use the k-th most (or least) anomalous pixel")
+    paa("--topk",type=int,
+        help="Use the mean of the k most (or least) anomalous pixels")
     paa("--xpand","-x",nargs=2,type=float,
         help="Percentile clips; eg '-x 1 99'")
     paa("--output","-o",default='mean.jpg',
@@ -24,11 +34,140 @@ def _getargs():
         help="Read fle to get mean image")
     paa("--outmean",
         help="Write mean image to this file")
+    paa("--instats",action='append',
+        help="Read (and merge) statistics file (repeat for several) to get mean image")
+    paa("--outstats",
+        help="Write statistics (.npz) of the images to this file")
+    paa("--window",type=int,
+        help="Distances from the moving mean of this many frames, not the mean of all")
+    paa("--plan-scale",type=int,default=1,
+        help="Select anomalous pixels on images reduced by this factor")
+    paa("--outplan",
+        help="Write selected file index of every pixel (.npy or .png)")
+    paa("--inplan",
+        help="Read selected file indices, and just build the image")
     paa("--verbose","-v",action="count",default=0,
         help="verbose")
     args = argparser.parse_args()
     return args
 
+def _getmean(allfiles,args,cache,scale=1,rows=slice(None)):
+    '''mean image (reduced by scale; or just the given rows),
+    and exif to use for output'''
+    if args.inmean:
+        with Image.open(args.inmean) as im:
+            exifbase = im.getexif()
+            npmean = np.asarray(im)
+        multifile.checkshape(npmean,allfiles,args.inmean)
+        npmean = np.array(npmean[rows],dtype=float)
+    elif args.instats:
+        exifbase = multifile.readexif(multifile.firstfile(allfiles))
+        npmean = loadstats(args.instats).mean()
+        multifile.checkshape(npmean,allfiles,' '.join(args.instats))
+    else:
+        stats = FrameStats(full=bool(args.outstats))
+        frames = multifile.getframes(allfiles,args,cache,scale=scale)
+        for n,infile,npim,exif in v.vtqdm(frames,total=len(allfiles)):
+            if stats.count==0:
+                ## exif of the first frame that opened (only)
+                exifbase = multifile.readexif(infile)
+            stats.add(npim[rows])
+        if args.outstats:
+            stats.save(args.outstats)
+        npmean = stats.mean()
+        scale = 1 ## frames were already reduced
+    if args.outmean:
+        immean = Image.fromarray(np.asarray(npmean,dtype=np.uint8))
+        immean.save(args.outmean,quality="high",exif=exifbase)
+    if scale > 1:
+        npmean = reduce_array(npmean,scale)
+    return npmean,exifbase
+
+def _update(npim,npmean,bestdist,ndx,npanom,n,better):
+    '''insert, in place, frame n into the best k distances, their file
+    indices, and their pixel values (arrays of shape (k,rows,...), each
+    sorted best first, for the same rows as npim)'''
+    d = np.mean((np.asarray(npim,dtype=float) - npmean)**2,axis=2)
+    ## position of d among the best so far: after all that are at least
+    ## as good, so ties go to the earlier file, just as np.argmax does
+    pos = np.zeros(d.shape,dtype=int)
+    for best in bestdist:
+        pos += ~better(d,best)
+    for j in range(len(bestdist)-1,-1,-1):
+        shift = pos < j
+        if np.any(shift):
+            bestdist[j][shift] = bestdist[j-1][shift]
+            ndx[j][shift] = ndx[j-1][shift]
+            npanom[j][shift] = npanom[j-1][shift]
+        win = pos == j
+        bestdist[j][win] = d[win]
+        ndx[j][win] = n
+        npanom[j][win] = npim[win]
+
+def _select(allfiles,args,cache,npmean,scale=1,rows=slice(None)):
+    '''index of the most anomalous file at every pixel, and the
+    values of those pixels (at images reduced by scale; or just
+    the given rows); or, with --rank k, the k-th most anomalous;
+    or, with --topk k, the mean of the k most anomalous values;
+    with --window, distances are from the moving mean (npmean is None)'''
+    ## streaming selection: keep only the best k distances so far,
+    ## the indices of the files that achieved them, and their pixel
+    ## values, so memory is O(k) frames, however many files
+    better = np.less if args.mindist else np.greater
+    k = args.topk or args.rank
+    bestdist = None
+    frames = multifile.getframes(allfiles,args,cache,scale=scale)
+    frames = ((n,infile,npim[rows],exif) for n,infile,npim,exif in frames)
+    if args.window:
+        frames = moving_means(frames,args.window)
+    else:
+        frames = (frame + (npmean,) for frame in frames)
+    for n,infile,npim,exif,npbase in v.vtqdm(frames,total=len(allfiles)):
+        if bestdist is None:
+            bestdist = np.full((k,)+npim.shape[:2],
+                               np.inf if args.mindist else -np.inf)
+            ndx = np.full((k,)+npim.shape[:2],n,dtype=label_dtype(len(allfiles)))
+            npanom = np.zeros((k,)+npim.shape,dtype=npim.dtype)
+        ## rows are split among threads; each updates its own rows
+        bands.bandmap(lambda r: _update(npim[r],npbase[r],bestdist[:,r],
+                                        ndx[:,r],npanom[:,r],n,better),
+                      npim.shape[0],args.threads)
+    if args.topk:
+        return ndx[0],npanom.mean(axis=0)
+    return ndx[k-1],npanom[k-1]
+
+def _render(allfiles,args,cache,ndx):
+    '''gather full-resolution pixels, as chosen by the (upsampled) ndx;
+    each chosen file is read once, unchosen files not at all'''
+    with Image.open(multifile.firstfile(allfiles)) as im:
+        npixels = im.size
+    pixels = pixel_groups(upsample_labels(ndx,npixels))
+    chosen = sorted(pixels)
+    npanom = None
+    frames = multifile.getframes([allfiles[n] for n in chosen],args,cache)
+    for k,infile,npim,exif in v.vtqdm(frames,total=len(chosen)):
+        if npanom is None:
+            npanom = np.zeros_like(npim)
+        composite(npanom,npim,pixels[chosen[k]])
+    return npanom
+
+def _selectbands(allfiles,args,cache,bandlist):
+    '''_select, one band of rows at a time (with the mean of that band)'''
+    ndx = npanom = exifbase = None
+    for rows in bandlist:
+        v.vprint(f'Rows {rows.start}:{rows.stop}')
+        npmean,exifbase = None,multifile.readexif(multifile.firstfile(allfiles))
+        if not args.window:
+            npmean,exifbase = _getmean(allfiles,args,cache,rows=rows)
+        ndxband,npband = _select(allfiles,args,cache,npmean,rows=rows)
+        if ndx is None:
+            height = bandlist[-1].stop
+            ndx = np.empty((height,)+ndxband.shape[1:],dtype=ndxband.dtype)
+            npanom = np.empty((height,)+npband.shape[1:],dtype=npband.dtype)
+        ndx[rows] = ndxband
+        npanom[rows] = npband
+    return ndx,npanom,exifbase
+
 def _main(args):
     '''main'''
     v.vprint(args)
@@ -36,57 +175,67 @@ def _main(args):
     imbase = None
     allfiles = multifile.getfiles(args)
     nfiles = len(allfiles)
+    scale = args.plan_scale
 
-    v.vprint('First pass: get mean')
-    if args.inmean:
-        with Image.open(args.inmean) as im:
-            exifbase = im.getexif()
-            npmean = np.array(im,dtype=float)
-    else:
-        npmean=0
-        for n,infile in v.vtqdm(enumerate(allfiles),total=nfiles):
-            with Image.open(infile) as im:
-                if n==0:
-                    exifbase = im.getexif()
-                npim = np.array(im,dtype=float)
-                npmean = npmean + npim
-        npmean /= nfiles
-    if args.outmean:
-        immean = Image.fromarray(np.asarray(npmean,dtype=np.uint8))
-        immean.save(args.outmean,quality="high",exif=exifbase)
+    if args.max_memory and (args.instats or args.outstats or args.outmean):
+        raise RuntimeError('Cannot use --max-memory with --instats, '
+                           '--outstats, or --outmean')
+    if args.plan_scale > 1 and (args.outstats or args.outmean):
+        ## the mean of reduced frames is reduced: not for full-size use
+        raise RuntimeError('Cannot use --outstats or --outmean with --plan-scale')
+    k = args.topk or args.rank
+    if args.topk and args.rank > 1:
+        raise RuntimeError('Cannot use both --rank and --topk')
+    if k < 1 or k > nfiles:
+        raise RuntimeError(f'Cannot select {k} of {nfiles} files')
+    if args.topk and (args.outplan or args.inplan or scale > 1):
+        raise RuntimeError('A blend of --topk pixels is not a plan: cannot use '
+                           '--outplan, --inplan, or --plan-scale')
+    if args.window is not None and args.window < 1:
+        raise RuntimeError('--window must be at least 1')
+    if args.window and (args.inmean or args.instats or
+                        args.outmean or args.outstats):
+        raise RuntimeError('With --window, there is no single mean: cannot use '
+                           '--inmean, --instats, --outmean, or --outstats')
+    ## exif, and image size, from the first file that opens
+    basefile = multifile.firstfile(allfiles)
+    bandlist = [slice(None)]
+    if not args.inplan and scale == 1:
+        bandlist = bands.getbands(args,basefile,5+k)
 
-    v.vprint('Second pass: get distances')
-    distances = list()
-    for n,infile in v.vtqdm(enumerate(allfiles),total=nfiles):
-        with Image.open(infile) as im:
-            npim = np.array(im,dtype=float)
-            d = np.mean((npim - npmean)**2,axis=2)
-            distances.append(d)
+    with bands.bandcache(args,len(bandlist) > 1):
+        cache = multifile.getcache(args)
+        if args.inplan:
+            v.vprint('Read plan:',args.inplan)
+            ndx = load_labels(args.inplan,nfiles)
+            exifbase = multifile.readexif(basefile)
+        elif len(bandlist) > 1:
+            v.vprint('Two passes per band: get mean, keep anomalous pixels')
+            ndx,npanom,exifbase = _selectbands(allfiles,args,cache,bandlist)
+        elif args.window:
+            v.vprint('One pass: get distances from moving mean, keep anomalous pixels')
+            npmean,exifbase = None,multifile.readexif(basefile)
+            ndx,npanom = _select(allfiles,args,cache,npmean,scale)
+        else:
+            v.vprint('First pass: get mean')
+            npmean,exifbase = _getmean(allfiles,args,cache,scale)
+            v.vprint('Second pass: get distances, keep anomalous pixels')
+            ndx,npanom = _select(allfiles,args,cache,npmean,scale)
+        if args.outplan and not args.inplan:
+            save_labels(args.outplan,ndx)
 
-    distances = np.array(distances,dtype=float)
-    v.vvprint('distances:',distances.shape)
+        if args.inplan or scale > 1:
+            v.vprint('Third pass: build image from anomalies')
+            npanom = _render(allfiles,args,cache,ndx)
 
-    argfcn = np.argmin if args.mindist else np.argmax
-    ndx = argfcn(distances,axis=0)
-    ndx = ndx.reshape(*ndx.shape,1)
     v.vvprint('ndx:',ndx.shape)
-
     ndxset = set(np.ravel(ndx))
     v.vprint('ndxset:',len(ndxset),'/',nfiles,ndxset)
 
-    npanom = 0*npmean
-    v.vprint('Third pass: build image from anomalies')
-    for n,infile in v.vtqdm(enumerate(allfiles),total=nfiles):
-        if n in ndxset:
-            with Image.open(infile) as im:
-                npim = np.array(im,dtype=float)
-                npanom += (ndx == n)*npim
-
     if args.xpand:
-        xlo,xhi = np.percentile(npanom,args.xpand)
+        xlo,xhi = xpand.Histogram().add(npanom).percentile(args.xpand,npanom)
         v.vprint('Expand:',xlo,xhi,255/(xhi-xlo))
-        npanom = 255*(npanom - xlo)/(xhi-xlo)
-        npanom = np.clip(npanom,0,255)
+        npanom = xpand.stretch(npanom,xlo,xhi)
 
     v.vprint('Base image:',npanom.shape,np.min(npanom),np.max(npanom))        
     npanom = np.asarray(npanom,dtype=np.uint8)
@@ -1,4 +1,5 @@
 '''transpose/angles: enables rotation > 60 degrees by transposing if necessary'''
+import numpy as np
 from PIL import Image
 
 def transpose_angle(angle):
@@ -29,3 +30,17 @@ def trotate_back(img,angle):
         img = img.transpose(method=transpose)
     return img
 
+def untrotate_labels(labels,angle,size):
+    '''
+    labels is an int array defined on the (expanded) canvas made by
+    trotate from an image of the given size; return, for every pixel
+    of the original image, the label that trotate_back (and cropping
+    to size) would have put there, or -1 if that is outside the canvas
+    '''
+    owidth,oheight = size
+    im = Image.fromarray(np.asarray(labels,dtype=np.int32)+1)
+    im = trotate_back(im,angle)
+    width,height = im.size
+    im = im.crop(((width-owidth)//2,(height-oheight)//2,
+                  (width+owidth)//2,(height+oheight)//2))
+    return np.asarray(im,dtype=np.int32) - 1
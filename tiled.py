@@ -11,9 +11,10 @@ import argparse
 import random
 from PIL import Image
 import verbose as v
-from tiles import Tiles
-from tangles import trotate,trotate_back
+import numpy as np
+from tiles import Tiles,composite
 import multifile
+from gapify import gapify
 
 def _getargs():
     '''parse options from command line'''
@@ -32,6 +33,12 @@ def _getargs():
         help="Write output interval image to this file")
     paa("--angle",type=float,default=0,
         help="Rotate image by angle (degrees)")
+    paa("--gap","-g",type=int,default=0,
+        help="Number of pixels in gaps between tiles (as gapify)")
+    paa("--frame",action="store_true",
+        help="Include a frame around the whole image (with --gap)")
+    paa("--color",
+        help="Color for frame/gaps")
     paa("--verbose","-v",action="count",default=0,
         help="verbose")
     args = argparser.parse_args()
@@ -53,8 +60,9 @@ def _main(args):
         ## not necessary, since randomize again below
         random.shuffle(allfiles)
 
+    uniqfiles = list(allfiles)
     if args.cycle > 1:
-        allfiles = list(allfiles) * args.cycle
+        allfiles = uniqfiles * args.cycle
 
     nfiles = len(allfiles)
     ntiles = (nfiles,nfiles) if not args.tiles else args.tiles
@@ -66,34 +74,36 @@ def _main(args):
     if args.random:
         alltiles.setup_random(nfiles=nfiles)
     
+    cache = multifile.getcache(args)
+
     basefile = allfiles[0]
     with Image.open(basefile) as baseim:
-        owidth,oheight = baseim.size
-        if args.angle:
-            baseim = trotate(baseim,args.angle)
+        exifbase = baseim.getexif()
         width,height = baseim.size
-        v.vprint(f'({owidth},{oheight}) -> ({width},{height})')
-
-        for n,infile in v.vtqdm(enumerate(allfiles),total=nfiles):
-            boxes = alltiles.get_boxes_with_ndx(n,(width,height))
-            try:
-                with Image.open(infile) as im:
-                    if args.angle:
-                        im = trotate(im,args.angle)
-                    for box in boxes:
-                        region = im.crop(box)
-                        baseim.paste(region,box)
-            except OSError:
-                v.print('Failed to open file:',infile)
-                pass
 
-        if args.angle:
-            baseim = trotate_back(baseim,args.angle)
-            width,height=baseim.size
-            baseim = baseim.crop(((width-owidth)//2,(height-oheight)//2,
-                                  (width+owidth)//2,(height+oheight)//2))
+        ## every pixel of the composite is labeled by the file it comes
+        ## from; then each file contributes all its pixels in one gather
+        ## (with --angle, the tiles are rotated, but the images are not);
+        ## with --cycle, that is the file, not which copy of it, so each
+        ## file is read once for the tiles of all its copies
+        labels = alltiles.labelmap((width,height),angle=args.angle,
+                                   nfiles=len(uniqfiles))
+        pixels = alltiles.pixel_groups((width,height),labels=labels)
+        npbase = np.array(baseim)
+        ## only the files that got some tiles are read at all
+        chosen = sorted(n for n in pixels if n >= 0)
+        v.vprint('Files used:',len(chosen),'/',len(uniqfiles))
+        frames = multifile.getframes([uniqfiles[n] for n in chosen],args,cache)
+        for k,infile,npim,exif in v.vtqdm(frames,total=len(chosen)):
+            composite(npbase,npim,pixels[chosen[k]])
+        baseim = Image.fromarray(npbase)
+        if args.gap:
+            ## gapped here, not by gapify on the saved image: one less
+            ## JPEG decode and (lossy) encode
+            baseim = gapify(baseim,ntiles,args.gap,frame=args.frame,
+                            color=args.color,angle=args.angle)
 
-        baseim.save(args.output,quality="high",exif=baseim.getexif())
+        baseim.save(args.output,quality="high",exif=exifbase)
     
 if __name__ == "__main__":
 
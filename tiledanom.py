@@ -7,21 +7,27 @@
 ## using --tiles 0 2, you'll see plain horizontal stripes
 ## using --tiles 0 2 --random, you'll see horizontal stripes split into two
 
+import os
 import sys
 import argparse
+import hashlib
 import random
 import numpy as np
 from PIL import Image
 import verbose as v
-from tiles import Tiles
-from tangles import trotate,trotate_back
+from tiles import Tiles,composite,integral_image,save_labels,load_labels,pixel_groups
 import multifile
+import bands
+from framestats import FrameStats,loadstats,moving_means
+from framecache import filestamp,reduced_size,reduce_array
+import auction
 
 def _getargs():
     '''parse options from command line'''
     argparser = argparse.ArgumentParser(description=__doc__)
     paa = argparser.add_argument
     multifile.addargs(argparser)
+    bands.addargs(argparser)
     paa("--reverse","-r",action="store_true",
         help="Time right-to-left instead")
     paa("--random",action="store_true",
@@ -32,12 +38,30 @@ def _getargs():
         help="How many tiles (wxh)")
     paa("--mindist",action="store_true",
         help="Use least anomalous (minimum distance) tiles")
+    paa("--maxuse",type=int,
+        help="Use each file for at most this many tiles (maximizing total anomaly)")
     paa("--output","-o",required=True,
         help="Write output interval image to this file")
     paa("--inmean",
         help="Read fle to get mean image")
     paa("--outmean",
         help="Write mean image to this file")
+    paa("--instats",action='append',
+        help="Read (and merge) statistics file (repeat for several) to get mean image")
+    paa("--outstats",
+        help="Write statistics (.npz) of the images to this file")
+    paa("--window",type=int,
+        help="Distances from the moving mean of this many frames, not the mean of all")
+    paa("--distcache",
+        help="Directory for cache of tile distances")
+    paa("--plan-scale",type=int,default=1,
+        help="Select tiles on images reduced by this factor")
+    paa("--refine",type=int,
+        help="Rescore this many candidate files per tile, selected with --plan-scale, at full resolution")
+    paa("--outplan",
+        help="Write selected file index of every tile (.npy or .png)")
+    paa("--inplan",
+        help="Read selected file indices, and just build the image")
     paa("--angle",type=float,default=0,
         help="Rotate image by angle (degrees)")
     paa("--verbose","-v",action="count",default=0,
@@ -45,11 +69,200 @@ def _getargs():
     args = argparser.parse_args()
     return args
 
-def tile_distance(x,y):
-    ''' x and y should be np arrays of the same size'''
-    assert x.shape == y.shape
-    return np.sqrt(np.mean((x-y)**2))
-        
+def _distcachefile(args,allfiles,ntiles):
+    '''file for cached tile distances; keyed by the input files, the tile
+    grid and angle, and where the mean comes from'''
+    if args.window:
+        meansource = [f'window={args.window}']
+    elif args.inmean:
+        meansource = ['inmean',filestamp(args.inmean)]
+    elif args.instats:
+        meansource = ['instats'] + [filestamp(f) for f in args.instats]
+    else:
+        meansource = ['files']
+    ident = '\n'.join([filestamp(f) for f in allfiles] +
+                      [f'tiles={ntiles[0]}x{ntiles[1]}',f'angle={args.angle}',
+                       f'scale={args.plan_scale}'] +
+                      meansource)
+    os.makedirs(args.distcache,exist_ok=True)
+    key = hashlib.sha1(ident.encode()).hexdigest()
+    return os.path.join(args.distcache,key + '.npy')
+
+def _getmean(allfiles,args,cache,scale=1,rows=slice(None)):
+    '''mean image (reduced by scale; or just the given rows), from files,
+    or from --inmean or --instats'''
+    if args.inmean:
+        with Image.open(args.inmean) as im:
+            npmean = np.asarray(im)
+        multifile.checkshape(npmean,allfiles,args.inmean)
+        npmean = np.array(npmean[rows],dtype=float)
+    elif args.instats:
+        npmean = loadstats(args.instats).mean()
+        multifile.checkshape(npmean,allfiles,' '.join(args.instats))
+    else:
+        stats = FrameStats(full=bool(args.outstats))
+        frames = multifile.getframes(allfiles,args,cache,scale=scale)
+        for n,infile,npim,exif in v.vtqdm(frames,total=len(allfiles)):
+            stats.add(npim[rows])
+        if args.outstats:
+            stats.save(args.outstats)
+        npmean = stats.mean()
+        scale = 1 ## frames were already reduced
+    if args.outmean:
+        immean = Image.fromarray(np.asarray(npmean,dtype=np.uint8))
+        immean.save(args.outmean,quality="high")
+    if scale > 1:
+        npmean = reduce_array(npmean,scale)
+    return npmean
+
+def _tilesums(allfiles,args,cache,alltiles,tmap,npmean,scale=1,rows=slice(None)):
+    '''
+    array (nfiles,ntiles) of sums, over the pixels of each tile, of the
+    squared distance to mean (averaged over channels); sums over whole
+    rectangular tiles come from the integral image of the squared-distance
+    map, rotated tiles (given by tmap), or the parts of tiles in the given
+    rows, are summed by label; files that failed to open have sum nan;
+    images (and tmap, and npmean) are reduced by scale; with --window,
+    distances are to the moving mean (and npmean is None)
+    '''
+    height,width = tmap.shape
+    tflat = tmap[rows].ravel() + 1 ## label 0 is for pixels in no tile
+    ntile = len(alltiles)
+    nfiles = len(allfiles)
+    dsum = np.full((nfiles,ntile),np.nan)
+    frames = multifile.getframes(allfiles,args,cache,scale=scale)
+    frames = ((n,infile,npim[rows],exif) for n,infile,npim,exif in frames)
+    if args.window:
+        frames = moving_means(frames,args.window)
+    else:
+        frames = (frame + (npmean,) for frame in frames)
+    for n,infile,npim,exif,npbase in v.vtqdm(frames,total=nfiles):
+        d = np.empty(npim.shape[:2])
+        ## rows of the squared-distance map are split among threads
+        bands.bandmap(lambda r: np.mean((np.asarray(npim[r],dtype=float)
+                                         - npbase[r])**2,axis=2,out=d[r]),
+                      d.shape[0],args.threads)
+        if args.angle or d.shape != tmap.shape:
+            dsum[n] = np.bincount(tflat,weights=d.ravel(),minlength=ntile+1)[1:]
+        else:
+            dsum[n] = alltiles.box_sums(integral_image(d),(width,height))
+    return dsum
+
+def _distances(dsum,alltiles,tmap):
+    '''tile distances to mean, from the sums of squared distance:
+    rms over the pixels and channels of the tile;
+    tiles with no pixels have distance nan'''
+    npixtile = np.bincount(tmap.ravel()+1,minlength=len(alltiles)+1)[1:]
+    with np.errstate(invalid='ignore',divide='ignore'):
+        return np.sqrt(dsum/npixtile)
+
+def _selection_distances(allfiles,args,cache,alltiles,npixels,tmap,
+                         bandlist=(slice(None),),npmean=None):
+    '''tile distances, from the cache, or else by passing through files
+    (on images reduced by --plan-scale, if that is given; or, with
+    several bands, two passes per band, summing tiles across bands);
+    npmean, if given, is the full-resolution mean, already read'''
+    scale = args.plan_scale
+    distfile = None
+    if args.distcache:
+        distfile = _distcachefile(args,allfiles,alltiles.ntiles)
+        if os.path.exists(distfile):
+            v.vprint('Reading tile distances:',distfile)
+            dist = np.load(distfile)
+            if npmean is None and (args.outmean or args.outstats):
+                _getmean(allfiles,args,cache,scale)
+            return dist
+
+    if scale > 1:
+        tmap = alltiles.tilemap(reduced_size(npixels,scale),angle=args.angle)
+    if len(bandlist) > 1:
+        v.vprint('Two passes per band: compute mean, distances from mean')
+        dsum = 0
+        for rows in bandlist:
+            v.vprint(f'Rows {rows.start}:{rows.stop}')
+            npmean = None if args.window else _getmean(allfiles,args,cache,rows=rows)
+            dsum = dsum + _tilesums(allfiles,args,cache,alltiles,tmap,
+                                    npmean,rows=rows)
+    elif args.window:
+        v.vprint('One pass: compute distances from moving mean')
+        dsum = _tilesums(allfiles,args,cache,alltiles,tmap,None,scale)
+    else:
+        if npmean is None:
+            v.vprint('First pass: compute mean')
+            npmean = _getmean(allfiles,args,cache,scale)
+        elif scale > 1:
+            npmean = reduce_array(npmean,scale)
+        v.vprint('Second pass: compute distances from mean')
+        dsum = _tilesums(allfiles,args,cache,alltiles,tmap,npmean,scale)
+    ## float32, so runs with and without the cache agree
+    dist = np.asarray(_distances(dsum,alltiles,tmap),dtype=np.float32)
+    if distfile:
+        ## as framecache does: an interrupted run leaves no partial file
+        tmpfile = f'{distfile}.{os.getpid()}.tmp'
+        with open(tmpfile,'wb') as fp:
+            np.save(fp,dist)
+        os.replace(tmpfile,distfile)
+    return dist
+
+def _refined_distances(allfiles,args,cache,tmap,dist,npmean):
+    '''
+    tile distances at full resolution (tmap is the full-resolution
+    tilemap, npmean the full-resolution mean) for the best --refine
+    candidates of each tile, chosen by dist (distances on images reduced
+    by --plan-scale); other entries are nan; only files that are
+    candidates for some tile are read
+    '''
+    height,width = tmap.shape
+    score = -dist if args.mindist else dist
+    score = np.where(np.isnan(score),-np.inf,score)
+    ncand = min(args.refine,len(allfiles))
+    top = np.argpartition(-score,ncand-1,axis=0)[:ncand]
+    cand = np.zeros(score.shape,dtype=bool)
+    np.put_along_axis(cand,top,True,axis=0)
+    cand &= np.isfinite(score)
+    candfiles = np.flatnonzero(cand.any(axis=1))
+    v.vprint(f'Refine: {cand.sum()} candidate tiles, in {len(candfiles)} '
+             f'of {len(allfiles)} files, at full resolution')
+    meanflat = npmean.reshape(width*height,-1)
+    tpixels = pixel_groups(tmap)
+    refined = np.full(dist.shape,np.nan)
+    frames = multifile.getframes([allfiles[n] for n in candfiles],args,cache)
+    for k,infile,npim,exif in v.vtqdm(frames,total=len(candfiles)):
+        n = candfiles[k]
+        flat = npim.reshape(width*height,-1)
+        for t in np.flatnonzero(cand[n]):
+            pix = tpixels[t]
+            refined[n,t] = np.sqrt(np.mean((flat[pix] - meanflat[pix])**2))
+    return np.asarray(refined,dtype=np.float32)
+
+def _maxuse_selection(score,maxuse,nuniq):
+    '''
+    file (index into the nuniq unique files) for each tile, with each
+    file used for at most maxuse tiles, and the total score (nfiles,ntiles;
+    -inf for files that failed to open, tiles with no pixels, and tiles
+    not scored) of the selected tiles a maximum; with --cycle, the copies
+    of a file are scored by the best of them; tiles with no pixels keep
+    argmax
+    '''
+    score = score.reshape(-1,nuniq,score.shape[1]).max(axis=0)
+    ndx = np.argmax(score,axis=0)
+    okfiles = np.flatnonzero(np.isfinite(score).any(axis=1))
+    oktiles = np.flatnonzero(np.isfinite(score).any(axis=0))
+    if len(okfiles)*maxuse < len(oktiles):
+        raise RuntimeError(f'Cannot fill {len(oktiles)} tiles from {len(okfiles)} '
+                           f'files with --maxuse {maxuse}')
+    v.vprint(f'Assigning {len(oktiles)} tiles to {len(okfiles)} files, '
+             f'at most {maxuse} each')
+    benefit = score[np.ix_(okfiles,oktiles)].T
+    ## tiles not scored for a file (see --refine) get a score so low that
+    ## any assignment avoiding them is better
+    finite = np.isfinite(benefit)
+    if not finite.all():
+        lo,hi = benefit[finite].min(),benefit[finite].max()
+        benefit = np.where(finite,benefit,lo - (hi-lo+1)*len(oktiles))
+    ndx[oktiles] = okfiles[auction.assign(benefit,maxuse)]
+    return ndx
+
 def _main(args):
     '''main'''
     v.vprint(args)
@@ -66,8 +279,9 @@ def _main(args):
         ## not necessary, since randomize again below
         random.shuffle(allfiles)
 
+    uniqfiles = list(allfiles)
     if args.cycle > 1:
-        allfiles = list(allfiles) * args.cycle
+        allfiles = uniqfiles * args.cycle
 
     nfiles = len(allfiles)
     ntiles = (nfiles,nfiles) if not args.tiles else args.tiles
@@ -79,81 +293,104 @@ def _main(args):
     if args.random:
         alltiles.setup_random(nfiles=nfiles)
     
+    if args.maxuse is not None and args.maxuse < 1:
+        raise RuntimeError('--maxuse must be at least 1')
+    if args.refine is not None:
+        if args.refine < 1:
+            raise RuntimeError('--refine must be at least 1')
+        if args.plan_scale == 1:
+            raise RuntimeError('--refine needs --plan-scale, for the first selection')
+        if args.window:
+            raise RuntimeError('Cannot use --refine with --window')
+        if not (args.inmean or args.instats):
+            ## a reduced mean, enlarged, lacks the fine detail of the
+            ## frames, which would then count as anomaly
+            raise RuntimeError('--refine needs the full-resolution mean, '
+                               'from --inmean or --instats')
+    if args.maxuse and args.inplan:
+        v.print("Option --maxuse is meaningless when --inplan is used!")
+    if args.max_memory and (args.instats or args.outstats or args.outmean):
+        raise RuntimeError('Cannot use --max-memory with --instats, '
+                           '--outstats, or --outmean')
+    if args.plan_scale > 1 and (args.outstats or args.outmean):
+        ## the mean of reduced frames is reduced: not for full-size use
+        raise RuntimeError('Cannot use --outstats or --outmean with --plan-scale')
+    if args.window is not None and args.window < 1:
+        raise RuntimeError('--window must be at least 1')
+    if args.window and (args.inmean or args.instats or
+                        args.outmean or args.outstats):
+        raise RuntimeError('With --window, there is no single mean: cannot use '
+                           '--inmean, --instats, --outmean, or --outstats')
+    bandlist = [slice(None)]
+    if not args.inplan and args.plan_scale == 1:
+        bandlist = bands.getbands(args,allfiles[0],4)
+
     basefile = allfiles[0]
-    with Image.open(basefile) as baseim:
-        owidth,oheight = baseim.size
-        if args.angle:
-            baseim = trotate(baseim,args.angle)
+    with bands.bandcache(args,len(bandlist) > 1), Image.open(basefile) as baseim:
+        cache = multifile.getcache(args)
+        exifbase = baseim.getexif()
         width,height = baseim.size
-        v.vprint(f'({owidth},{oheight}) -> ({width},{height})')
 
-        ## first pass, compute average image
-        v.vprint('First pass: compute mean')
-        if args.inmean:
-            with Image.open(args.inmean) as im:
-                immean = im.copy()
+        ## every pixel is labeled by the tile it is in (with --angle,
+        ## the tiles are rotated, but the images are not); label 0 is
+        ## for pixels that are in no tile
+        tmap = alltiles.tilemap((width,height),angle=args.angle)
+
+        if args.inplan:
+            v.vprint('Read plan:',args.inplan)
+            plan = load_labels(args.inplan,nfiles)
+            if plan.shape != (nhtiles,nwtiles):
+                raise RuntimeError(f'Plan {args.inplan} is for {plan.shape[1]}x{plan.shape[0]} tiles, not {nwtiles}x{nhtiles}')
+            alltiles.ndx = plan.ravel()
         else:
-            for n,infile in v.vtqdm(enumerate(allfiles),total=nfiles):
-                with Image.open(infile) as im:
-                    if n==0:
-                        npmean = 0*np.array(im,dtype=float)
-                    npim = np.array(im,dtype=float)
-                    npmean += npim / nfiles
-            npmean = np.asarray(npmean,dtype=np.uint8)
-            immean = Image.fromarray(npmean)
-        if args.outmean:
-            immean.save(args.outmean,quality="high")
-
-        if args.angle:
-            immean = trotate(immean,args.angle)
-        ## still in first pass, break immean into tiles
-        for tile in alltiles.tiles:
-            box = tile.box(immean.size,ntiles)
-            ## add two new attributes to tile object
-            tile.immean = np.asarray(immean.crop(box),dtype=float)
-            tile.dist = list()
-
-        ## second pass, tile distance to mean for each infile
-        v.vprint('Second pass: compute distances from mean')
-        for n,infile in v.vtqdm(enumerate(allfiles),total=nfiles):
-            with Image.open(infile) as im:
-                if args.angle:
-                    im = trotate(im,args.angle)
-                for tile in alltiles.tiles:
-                    box = tile.box(im.size,ntiles)
-                    imtile = np.asarray(im.crop(box),dtype=float)
-                    d = tile_distance(tile.immean,imtile)
-                    tile.dist.append(d)
-
-        ## Now pass through tiles, finding largest distance
-        for tile in alltiles.tiles:
-            if args.mindist:
-                tile.ndx = tile.dist.index(min(tile.dist))
+            ## with --cycle, the copies of a file have the same distances
+            ## (but not with --window, where the moving mean wraps around),
+            ## so distances are found with each unique file read once
+            distfiles = allfiles if args.window else uniqfiles
+            ## --refine reads the full-resolution mean once, for both scales
+            npmean = _getmean(distfiles,args,cache) if args.refine else None
+            dist = _selection_distances(distfiles,args,cache,alltiles,
+                                        (width,height),tmap,bandlist,npmean)
+            if args.refine:
+                dist = _refined_distances(distfiles,args,cache,tmap,dist,npmean)
+            dist = np.tile(dist,(nfiles//len(distfiles),1))
+
+            ## Now pass through tiles, finding largest distance
+            ## (files that failed to open, and tiles with no pixels,
+            ## have distance nan, and are ignored)
+            score = -dist if args.mindist else dist
+            score = np.where(np.isnan(score),-np.inf,score)
+            if args.maxuse:
+                alltiles.ndx = _maxuse_selection(score,args.maxuse,len(uniqfiles))
             else:
-                tile.ndx = tile.dist.index(max(tile.dist))
-            v.vvprint(f'tile {(tile.iw,tile.ih)}: {tile.ndx} {min(tile.dist):.2f} {max(tile.dist):.2f}')
+                alltiles.ndx = np.argmax(score,axis=0)
+            if v.verbosity() > 1:
+                for k,tile in enumerate(alltiles.tiles):
+                    if np.all(np.isnan(dist[:,k])):
+                        continue
+                    v.vvprint(f'tile {(tile.iw,tile.ih)}: {tile.ndx} {np.nanmin(dist[:,k]):.2f} {np.nanmax(dist[:,k]):.2f}')
+            if args.outplan:
+                save_labels(args.outplan,alltiles.ndx.reshape(nhtiles,nwtiles))
 
         v.vprint("Third pass: paste anomalous patches into composite")
-        for n,infile in v.vtqdm(enumerate(allfiles),total=nfiles):
-            boxes = alltiles.get_boxes_with_ndx(n,(width,height))
-            try:
-                with Image.open(infile) as im:
-                    if args.angle:
-                        im = trotate(im,args.angle)
-                    for box in boxes:
-                        region = im.crop(box)
-                        baseim.paste(region,box)
-            except OSError:
-                v.print('Failed to open file:',infile)
-                pass
-
-        if args.angle:
-            baseim = trotate_back(baseim,args.angle)
-            width,height=baseim.size
-            baseim = baseim.crop(((width-owidth)//2,(height-oheight)//2,
-                                  (width+owidth)//2,(height+oheight)//2))
-
-        baseim.save(args.output,quality="high",exif=baseim.getexif())
+        npbase = np.array(baseim)
+        used = set()
+        ## in band mode, band by band, so that the labels and the pixel
+        ## index (8 bytes per pixel) are only ever the size of a band
+        for rows in bandlist:
+            labels = alltiles.labelmap((width,height),tmap=tmap[rows],
+                                       nfiles=len(uniqfiles))
+            pixels = alltiles.pixel_groups((width,height),labels=labels)
+            ## only the files that got some tiles are read at all
+            chosen = sorted(n for n in pixels if n >= 0)
+            used.update(chosen)
+            frames = multifile.getframes([uniqfiles[n] for n in chosen],args,cache)
+            for k,infile,npim,exif in v.vtqdm(frames,total=len(chosen)):
+                composite(npbase[rows],npim[rows],pixels[chosen[k]])
+        v.vprint('Files used:',len(used),'/',len(uniqfiles))
+        baseim = Image.fromarray(npbase)
+
+        baseim.save(args.output,quality="high",exif=exifbase)
 
     
 if __name__ == "__main__":
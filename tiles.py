@@ -1,4 +1,22 @@
-import random
+import numpy as np
+from PIL import Image
+import verbose as v
+from tangles import trotate,untrotate_labels
+
+def label_dtype(nlabels):
+    '''smallest signed integer dtype for labels -1 to nlabels (label
+    maps are per-pixel, so int64 would be 4x the size of int16)'''
+    for dtype in (np.int16,np.int32):
+        if nlabels < np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+def _groupby(labels):
+    '''dict: label -> array of positions (in order) with that label'''
+    order = np.argsort(labels,kind='stable')
+    sorted_labels = labels[order]
+    starts = np.flatnonzero(np.r_[True,sorted_labels[1:] != sorted_labels[:-1]])
+    return dict(zip(sorted_labels[starts].tolist(),np.split(order,starts[1:])))
 
 class Tile:
     def __init__(self,iw=0,ih=0,ndx=0):
@@ -14,41 +32,98 @@ class Tile:
         hlo = (0+self.ih) * nhpix // nhtil
         hhi = (1+self.ih) * nhpix // nhtil
         return (wlo,hlo,whi,hhi)
-        
+
+class _TileView(Tile):
+    '''a Tile whose iw, ih, and ndx live in the arrays of a Tiles object'''
+    def __init__(self,parent,k):
+        self._parent = parent
+        self._k = k
+
+    @property
+    def iw(self):
+        return int(self._parent.iw[self._k])
+
+    @property
+    def ih(self):
+        return int(self._parent.ih[self._k])
+
+    @property
+    def ndx(self):
+        return int(self._parent.ndx[self._k])
+
+    @ndx.setter
+    def ndx(self,ndx):
+        self._parent.ndx[self._k] = ndx
+        self._parent._groups = None
+
 class Tiles:
+    '''
+    ntiles[0] x ntiles[1] tiles, in row-major order, held as numpy arrays:
+    iw, ih (position of tile in the grid) and ndx (file assigned to tile).
+    The tiles attribute gives the same tiles as a list of Tile objects;
+    note that if the ndx array is modified in place (rather than assigned),
+    then invalidate() should be called.
+    '''
     def __init__(self,ntiles=(1,1)):
         self.ntiles=ntiles
-        self.tiles = []
-        for ih in range(self.ntiles[1]):
-            for iw in range(self.ntiles[0]):
-                self.tiles.append(Tile(iw,ih))
+        nwtil,nhtil = ntiles
+        self.ih,self.iw = np.divmod(np.arange(nwtil*nhtil),nwtil)
+        self._ndx = np.zeros(nwtil*nhtil,dtype=int)
+        self._tiles = None
+        self._groups = None
         self.setup=False
-        
+
+    @property
+    def ndx(self):
+        return self._ndx
+
+    @ndx.setter
+    def ndx(self,ndx):
+        self._ndx = np.asarray(ndx,dtype=int)
+        self._groups = None
+
+    def invalidate(self):
+        '''call after modifying ndx in place'''
+        self._groups = None
+
+    @property
+    def tiles(self):
+        '''list of Tile objects (views into the arrays)'''
+        if self._tiles is None:
+            self._tiles = [_TileView(self,k) for k in range(len(self.iw))]
+        return self._tiles
+
+    def __len__(self):
+        return len(self.iw)
+
     def setup_sequential(self,nfiles=1):
         ## everybody gets a turn
-        for ndx,tile in enumerate(self.tiles):
-            tile.ndx = ndx%nfiles
+        self.ndx = np.arange(len(self)) % nfiles
         self.setup=True
         return self
 
     def setup_brick(self,nfiles=1,nblocks=5):
         ## tiles are like bricks, 1xnblocks
         ## with staggered starting at each row
-        ndx = 0
-        for tile in self.tiles:
-            ndx = ndx+1
-            if tile.iw == 0:
-                ndx = nblocks*(ndx//nblocks)
-                ndx += ((nblocks//2)*tile.ih) % nblocks
-            tile.ndx = (ndx//nblocks)%nfiles
+        ## (counter runs across each row, but its value at the start
+        ## of a row is rounded down to a brick, and then staggered)
+        nwtil,nhtil = self.ntiles
+        starts = np.empty(nhtil,dtype=int)
+        count = 0
+        for ih in range(nhtil):
+            count = nblocks*((count+1)//nblocks)
+            count += ((nblocks//2)*ih) % nblocks
+            starts[ih] = count
+            count += nwtil-1
+        counts = starts[self.ih] + self.iw
+        self.ndx = (counts//nblocks)%nfiles
         self.setup=True
         return self
-        
+
     def setup_random(self,nfiles=1):
         ## iid random (ie, with replacement)
         ## (could end up leaving some out)
-        for tile in self.tiles:
-            tile.ndx = random.randrange(nfiles)
+        self.ndx = np.random.randint(nfiles,size=len(self))
         self.setup=True
         return self
 
@@ -56,34 +131,149 @@ class Tiles:
         ## like _random but makes sure everybody gets their turn
         if not self.setup:
             self.setup_sequential(nfiles=nfiles)
-        ndxlist = [tile.ndx for tile in self.tiles]
-        random.shuffle(ndxlist)
-        for ndx,tile in zip(ndxlist,self.tiles):
-            tile.ndx = ndx
+        self.ndx = np.random.permutation(self.ndx)
         return self
 
     def reshuffle(self):
         ## equivalent to random ordering of input files
         ## respects, for instance, "brick" structure
         assert self.setup
-        ndxlist = [tile.ndx for tile in self.tiles]
-        nfiles = max(ndxlist)+1
-        newndx = list(range(nfiles))
-        random.shuffle(newndx)
-        for tile in self.tiles:
-            tile.ndx = newndx[tile.ndx]
-        return self            
+        nfiles = self.ndx.max()+1
+        newndx = np.random.permutation(nfiles)
+        self.ndx = newndx[self.ndx]
+        return self
+
+    def edges(self,npixels,which=None):
+        '''arrays wlo,hlo,whi,hhi of box edges for tiles (all, or which)'''
+        nwpix,nhpix = npixels
+        nwtil,nhtil = self.ntiles
+        iw = self.iw if which is None else self.iw[which]
+        ih = self.ih if which is None else self.ih[which]
+        return ((0+iw) * nwpix // nwtil,
+                (0+ih) * nhpix // nhtil,
+                (1+iw) * nwpix // nwtil,
+                (1+ih) * nhpix // nhtil)
+
+    def box_sums(self,sat,npixels):
+        '''sums over the box of every tile, from a summed-area table
+        (see integral_image); O(1) per tile, whatever its size'''
+        wlo,hlo,whi,hhi = self.edges(npixels)
+        return sat[hhi,whi] - sat[hlo,whi] - sat[hhi,wlo] + sat[hlo,wlo]
+
+    def groups(self):
+        '''dict: ndx -> array of (positions of) tiles assigned to ndx'''
+        if self._groups is None:
+            self._groups = _groupby(self.ndx)
+        return self._groups
+
+    def tilemap(self,npixels,angle=0):
+        '''array (height,width) giving, for every pixel, the position
+        of the tile whose box contains it; with angle, the tiles are laid
+        out on the canvas that tangles.trotate would make, and the map is
+        rotated back to the original image (-1 for pixels in no tile);
+        of the smallest integer type that holds the tile positions'''
+        dtype = label_dtype(len(self))
+        if angle:
+            canvas = trotate(Image.new('L',npixels),angle).size
+            labels = untrotate_labels(self.tilemap(canvas),angle,npixels)
+            return labels.astype(dtype,copy=False)
+        nwpix,nhpix = npixels
+        nwtil,nhtil = self.ntiles
+        ## side='right' so that a pixel goes to the last box that starts
+        ## at or before it, skipping any empty boxes (if ntiles > npixels)
+        wlo = np.arange(nwtil) * nwpix // nwtil
+        hlo = np.arange(nhtil) * nhpix // nhtil
+        iw = (np.searchsorted(wlo,np.arange(nwpix),side='right') - 1).astype(dtype)
+        ih = (np.searchsorted(hlo,np.arange(nhpix),side='right') - 1).astype(dtype)
+        return ih[:,None]*dtype(nwtil) + iw[None,:]
+
+    def labelmap(self,npixels,angle=0,tmap=None,nfiles=None):
+        '''array (height,width) giving, for every pixel, the ndx of its
+        tile (-1 for pixels in no tile); tmap, if given, is the tilemap;
+        with nfiles, ndx is taken modulo nfiles (so that, when a list of
+        nfiles files is cycled, the label is the file, not its copy);
+        of the smallest integer type that holds the ndx'''
+        if tmap is None:
+            tmap = self.tilemap(npixels,angle)
+        ndx = self.ndx if nfiles is None else self.ndx % nfiles
+        ndx = ndx.astype(label_dtype(int(ndx.max(initial=0))+1))
+        return np.where(tmap<0,ndx.dtype.type(-1),ndx[tmap])
+
+    def pixel_groups(self,npixels,labels=None):
+        '''dict: ndx -> flat indices of the pixels in tiles assigned to ndx'''
+        if labels is None:
+            labels = self.labelmap(npixels)
+        return pixel_groups(labels)
 
     def get_boxes_with_ndx(self,ndx,npixels):
         '''use ndx=None to get all boxes'''
         if not self.setup:
             v.vprint('Need to setup tiles')
-        boxlist = []
-        for tile in self.tiles:
-            if ndx is None or tile.ndx == ndx:
-                boxlist.append( tile.box(npixels,self.ntiles) )
-        return boxlist
+        if ndx is None:
+            which = None
+        else:
+            which = self.groups().get(ndx)
+            if which is None:
+                return []
+        edges = self.edges(npixels,which)
+        return list(zip(*(e.tolist() for e in edges)))
 
     def get_boxes(self,npixels):
         '''get all boxes'''
-        return get_boxes_with_ndx(self,None,npixels)
+        return self.get_boxes_with_ndx(None,npixels)
+
+def pixel_groups(labels):
+    '''dict: label -> flat indices of the pixels with that label'''
+    labels = labels.ravel()
+    if labels.min() >= 0 and labels.max() < 2**16:
+        ## stable sort of 16-bit ints is a radix sort: O(npixels)
+        labels = labels.astype(np.uint16)
+    return _groupby(labels)
+
+def upsample_labels(labels,npixels):
+    '''nearest-neighbor resize of label map (height,width) to npixels'''
+    nwpix,nhpix = npixels
+    height,width = labels.shape
+    rows = np.arange(nhpix) * height // nhpix
+    cols = np.arange(nwpix) * width // nwpix
+    return labels[rows[:,None],cols[None,:]]
+
+def save_labels(filename,labels):
+    '''write label map as .npy, or (if labels fit) as 16-bit .png'''
+    if filename.lower().endswith('.npy'):
+        np.save(filename,labels)
+    else:
+        if labels.min() < 0 or labels.max() >= 2**16:
+            raise ValueError(f'Labels {labels.min()} to {labels.max()} do not '
+                             f'fit a 16-bit .png; use .npy for {filename}')
+        Image.fromarray(np.asarray(labels,dtype=np.uint16)).save(filename)
+
+def load_labels(filename,nlabels=None):
+    '''read label map written by save_labels; with nlabels, check that
+    every label is one of 0 to nlabels-1'''
+    if filename.lower().endswith('.npy'):
+        labels = np.load(filename)
+    else:
+        with Image.open(filename) as im:
+            labels = np.asarray(im,dtype=int)
+    if labels.ndim != 2 or labels.dtype.kind not in 'ui':
+        raise RuntimeError(f'Plan {filename} is not a 2-d array of labels')
+    if nlabels is not None and labels.size and (labels.min() < 0 or
+                                                labels.max() >= nlabels):
+        raise RuntimeError(f'Plan {filename} has labels {labels.min()} to '
+                           f'{labels.max()}, not 0 to {nlabels-1} '
+                           f'(is it for other files?)')
+    return labels
+
+def integral_image(npim):
+    '''summed-area table, padded with a leading row and column of zeros,
+    so the sum over box (wlo,hlo,whi,hhi) is
+    sat[hhi,whi] - sat[hlo,whi] - sat[hhi,wlo] + sat[hlo,wlo]'''
+    sat = np.zeros((npim.shape[0]+1,npim.shape[1]+1)+npim.shape[2:])
+    sat[1:,1:] = np.cumsum(np.cumsum(npim,axis=0),axis=1)
+    return sat
+
+def composite(out,frame,pixels):
+    '''copy the pixels (flat indices) of frame into out, in place'''
+    nflat = out.shape[0]*out.shape[1]
+    out.reshape(nflat,-1)[pixels] = frame.reshape(nflat,-1)[pixels]
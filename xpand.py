@@ -0,0 +1,107 @@
+'''percentile stretch (--xpand) of images, from histograms of their values'''
+
+## np.percentile partitions a copy of the whole image; but the values
+## of an image here are bounded (0 to 255), so the percentiles can be
+## read off a histogram instead, which is accumulated a band of rows at
+## a time, as the bands are made.  For integer images the histogram
+## has one bin per value, so the percentiles come straight from it; for
+## float images, the bins are 1/256 of a unit wide, and the histogram
+## only says which bin a percentile is in: the values in that bin (a
+## small fraction of the image) are then picked out of the image and
+## sorted.  Either way, the percentiles are exactly those of
+## np.percentile (with its default linear interpolation).
+
+import numpy as np
+
+def _lerp(a,b,t):
+    '''linear interpolation, rounded as np.percentile rounds it'''
+    if t >= 0.5:
+        return b - (b-a)*(1-t)
+    return a + (b-a)*t
+
+class Histogram:
+    '''histogram of the values, in [0,vmax], of an image (or of its bands)'''
+    chunk = 2**20 ## values binned at a time
+    def __init__(self,vmax=255,binsize=1/256):
+        self.vmax = vmax
+        self.binsize = binsize
+        self.counts = None
+        self.exact = None
+        self.dtype = None
+
+    def _bins(self,npim):
+        '''(values,bins) of npim (flat), one chunk at a time'''
+        nbins = len(self.counts)
+        for k in range(0,len(npim),self.chunk):
+            vals = npim[k:k+self.chunk]
+            if self.exact:
+                yield vals,np.minimum(vals,nbins-1)
+            else:
+                ## values are not negative, so truncation is floor
+                bins = (vals / self.binsize).astype(np.intp)
+                yield vals,np.minimum(bins,nbins-1,out=bins)
+
+    def add(self,npim):
+        '''add values of npim (an image, or a band of one) to the histogram'''
+        npim = np.asarray(npim).ravel()
+        if self.counts is None:
+            self.dtype = npim.dtype
+            self.exact = npim.dtype.kind in 'ui'
+            if self.exact:
+                self.binsize = 1
+            nbins = int(self.vmax / self.binsize) + 1
+            self.counts = np.zeros(nbins,dtype=np.int64)
+        elif npim.dtype != self.dtype:
+            raise ValueError(f'Histogram of {self.dtype} values, '
+                             f'cannot add {npim.dtype} values')
+        for vals,bins in self._bins(npim):
+            self.counts += np.bincount(bins,minlength=len(self.counts))
+        return self
+
+    def _inbin(self,npim,blo,bhi):
+        '''sorted values of npim in bins blo to bhi'''
+        lo = blo * self.binsize
+        hi = (bhi+1) * self.binsize if bhi < len(self.counts)-1 else np.inf
+        npim = np.asarray(npim).ravel()
+        inbin = []
+        for k in range(0,len(npim),self.chunk):
+            vals = npim[k:k+self.chunk]
+            inbin.append(vals[(vals >= lo) & (vals < hi)])
+        return np.sort(np.concatenate(inbin))
+
+    def percentile(self,q,npim=None):
+        '''percentiles q (in 0..100), as np.percentile would give them;
+        for a float image, npim is the (whole) image whose values were added'''
+        if not self.exact:
+            if npim is None or np.asarray(npim).dtype != self.dtype:
+                raise ValueError(f'Percentiles of a histogram of {self.dtype} '
+                                 'values need the same values, of the same type')
+        cum = np.cumsum(self.counts)
+        nvals = int(cum[-1])
+        ranks = []
+        for qq in q:
+            pos = qq/100 * (nvals-1)
+            klo = int(np.floor(pos))
+            ranks.append( (klo,min(klo+1,nvals-1),pos-klo) )
+        values = []
+        for klo,khi,t in ranks:
+            blo,bhi = np.searchsorted(cum,[klo,khi],side='right')
+            if self.exact:
+                vlo,vhi = float(blo),float(bhi)
+            else:
+                ## the values in those bins, and the ranks within them
+                inbin = self._inbin(npim,blo,bhi)
+                start = int(cum[blo] - self.counts[blo])
+                vlo,vhi = float(inbin[klo-start]),float(inbin[khi-start])
+            values.append(_lerp(vlo,vhi,t))
+        return values
+
+def stretch(npim,xlo,xhi,out=None,nrows=256):
+    '''uint8 image, npim stretched so that xlo,xhi go to 0,255 (and
+    clipped); done nrows at a time, so with no full-size float temporaries'''
+    if out is None:
+        out = np.empty(npim.shape,dtype=np.uint8)
+    for r in range(0,npim.shape[0],nrows):
+        band = 255*(np.asarray(npim[r:r+nrows],dtype=float) - xlo)/(xhi-xlo)
+        out[r:r+nrows] = np.clip(band,0,255)
+    return out